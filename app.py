@@ -18,6 +18,15 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-i
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///krishi360.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Crop photos and their thumbnails
+app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', os.path.join(app.instance_path, 'uploads'))
+
+# Minutes a cart line holds its stock; 0 disables holds
+app.config['CART_HOLD_MINUTES'] = int(os.environ.get('CART_HOLD_MINUTES', 0))
+
+# Seconds between automatic consultation routing runs; 0 disables routing
+app.config['CONSULTATION_ROUTING_SECONDS'] = int(os.environ.get('CONSULTATION_ROUTING_SECONDS', 0))
+
 # Mail configuration
 app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
 app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 587))
@@ -37,7 +46,14 @@ login_manager.login_view = 'auth.login'
 mail = Mail(app)
 
 # Import routes after app initialization
-from routes import auth, farmer, buyer, consultant, admin
+from routes import auth, farmer, buyer, consultant, admin, images
+from services.search import init_search_index
+from services.geo import init_coordinates
+from services.analytics import init_sales_rollups
+from services.market import init_price_history
+from services.sla import init_latency_sketches
+from services.holds import holds_enabled, start_hold_sweeper
+from services.routing import routing_interval, start_consultation_router
 
 # Register blueprints
 app.register_blueprint(auth.bp)
@@ -45,6 +61,7 @@ app.register_blueprint(farmer.bp)
 app.register_blueprint(buyer.bp)
 app.register_blueprint(consultant.bp)
 app.register_blueprint(admin.bp)
+app.register_blueprint(images.bp)
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -77,5 +94,14 @@ def internal_error(error):
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        init_search_index()
+        init_coordinates()
+        init_sales_rollups()
+        init_price_history()
+        init_latency_sketches()
+        if holds_enabled():
+            start_hold_sweeper(app)
+        if routing_interval():
+            start_consultation_router(app, routing_interval())
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the consultant specializations statistics
+
+Seeds a throwaway SQLite database with one consultant holding N
+consultations (10,000 by default) and times the old per-consultation
+rescan against the GROUP BY query and the cached result.
+
+    python benchmarks/specializations.py [N]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+
+from app import app, db
+from models import Consultation, User
+from services import consultations
+
+CATEGORIES = ['crop_management', 'pest_control', 'soil_health', 'irrigation', 'fertilizer', 'market_advice']
+STATUSES = ['pending', 'in_progress', 'completed', 'completed', 'completed', 'cancelled']
+
+def seed(count):
+    farmer = User(username='bench_farmer', email='farmer@bench.local', password_hash='-',
+                  first_name='Bench', last_name='Farmer', role='farmer')
+    consultant = User(username='bench_consultant', email='consultant@bench.local', password_hash='-',
+                      first_name='Bench', last_name='Consultant', role='consultant')
+    db.session.add_all([farmer, consultant])
+    db.session.commit()
+
+    rows = []
+    for i in range(count):
+        status = random.choice(STATUSES)
+        rows.append({
+            'title': f'Question {i}',
+            'description': 'Benchmark consultation',
+            'category': random.choice(CATEGORIES),
+            'status': status,
+            'priority': 'medium',
+            'rating': random.randint(1, 5) if status == 'completed' and random.random() < 0.7 else None,
+            'farmer_id': farmer.id,
+            'consultant_id': consultant.id
+        })
+    db.session.execute(Consultation.__table__.insert(), rows)
+    db.session.commit()
+    return consultant.id
+
+def legacy_category_stats(consultant_id):
+    """The statistics as the specializations page used to compute them"""
+    all_consultations = Consultation.query.filter_by(consultant_id=consultant_id).all()
+
+    category_stats = {}
+    for consultation in all_consultations:
+        category = consultation.category
+        if category not in category_stats:
+            category_stats[category] = {'total': 0, 'completed': 0, 'avg_rating': 0}
+
+        category_stats[category]['total'] += 1
+        if consultation.status == 'completed':
+            category_stats[category]['completed'] += 1
+            if consultation.rating:
+                cat_consultations = [c for c in all_consultations if c.category == category and c.rating is not None]
+                if cat_consultations:
+                    category_stats[category]['avg_rating'] = sum([c.rating for c in cat_consultations]) / len(cat_consultations)
+    return category_stats
+
+def timed(label, function, repeat):
+    best = None
+    for _ in range(repeat):
+        db.session.expunge_all()
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{label:<12} {best * 1000:10.2f} ms')
+    return result
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    random.seed(1)
+
+    with app.app_context():
+        db.create_all()
+        consultant_id = seed(count)
+        print(f'{count} consultations, best of 3')
+
+        legacy = timed('rescan', lambda: legacy_category_stats(consultant_id), 3)
+
+        def uncached():
+            consultations.invalidate([consultant_id])
+            return consultations.category_stats(consultant_id)
+
+        grouped = timed('group by', uncached, 3)
+        timed('cached', lambda: consultations.category_stats(consultant_id), 3)
+
+        for category, stats in legacy.items():
+            assert stats['total'] == grouped[category]['total']
+            assert stats['completed'] == grouped[category]['completed']
+            assert abs(stats['avg_rating'] - grouped[category]['avg_rating']) < 1e-9
+
+    os.remove(DB_PATH)
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,11 @@ Creates tables and adds sample data for testing
 
 from app import app, db
 from models import User, Crop, Order, Consultation, OrderItem
+from services.search import init_search_index
+from services.geo import init_coordinates
+from services.analytics import init_sales_rollups
+from services.market import init_price_history
+from services.sla import init_latency_sketches
 from werkzeug.security import generate_password_hash
 from datetime import datetime, date, timedelta
 import random
@@ -320,10 +325,15 @@ def main():
         
         # Create all tables
         db.create_all()
+        init_search_index()
         print("✓ Created database tables")
         
         # Check if data already exists
         if User.query.first():
+            init_coordinates()
+            init_sales_rollups()
+            init_price_history()
+            init_latency_sketches()
             print("⚠ Database already contains data. Skipping sample data creation.")
             return
         
@@ -1,11 +1,15 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy.orm import validates
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # Initialize db here - will be set by app.py
 db = SQLAlchemy()
 
+# Consultation priorities in queue order, most urgent first; unknown ones rank last
+CONSULTATION_PRIORITIES = ('urgent', 'high', 'medium', 'low')
+
 class User(UserMixin, db.Model):
     """User model with role-based access control"""
     __tablename__ = 'users'
@@ -18,6 +22,8 @@ class User(UserMixin, db.Model):
     last_name = db.Column(db.String(50), nullable=False)
     phone = db.Column(db.String(20), nullable=True)
     address = db.Column(db.Text, nullable=True)
+    latitude = db.Column(db.Float, nullable=True)  # geocoded from address
+    longitude = db.Column(db.Float, nullable=True)
     role = db.Column(db.String(20), nullable=False, default='farmer')  # farmer, buyer, consultant, admin
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -52,8 +58,11 @@ class Crop(db.Model):
     price_per_unit = db.Column(db.Float, nullable=False)
     unit = db.Column(db.String(20), nullable=False, default='kg')  # kg, ton, piece, etc.
     quantity_available = db.Column(db.Float, nullable=False)
+    quantity_held = db.Column(db.Float, nullable=False, default=0, server_default='0')  # in buyers' cart holds
     harvest_date = db.Column(db.Date, nullable=True)
     location = db.Column(db.String(200), nullable=False)
+    latitude = db.Column(db.Float, nullable=True)  # geocoded from location
+    longitude = db.Column(db.Float, nullable=True)
     image_url = db.Column(db.String(200), nullable=True)
     is_organic = db.Column(db.Boolean, default=False)
     is_active = db.Column(db.Boolean, default=True)
@@ -61,13 +70,22 @@ class Crop(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Foreign keys
-    farmer_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    farmer_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     
     # Relationships
     order_items = db.relationship('OrderItem', backref='crop', lazy=True)
     
+    __table_args__ = (
+        # Keyset pagination of the catalog, newest first
+        db.Index('ix_crops_active_created_id', 'is_active', 'created_at', 'id'),
+    )
+    
     def __repr__(self):
         return f'<Crop {self.name}>'
+    
+    def get_unheld_quantity(self):
+        """Stock not held in buyers' carts"""
+        return max(self.quantity_available - (self.quantity_held or 0), 0)
 
 class Order(db.Model):
     """Order model for buyers"""
@@ -81,6 +99,7 @@ class Order(db.Model):
     payment_method = db.Column(db.String(50), nullable=True)
     shipping_address = db.Column(db.Text, nullable=False)
     notes = db.Column(db.Text, nullable=True)
+    idempotency_key = db.Column(db.String(64), nullable=True)  # sent with the checkout form, dedupes retries
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -90,6 +109,12 @@ class Order(db.Model):
     # Relationships
     items = db.relationship('OrderItem', backref='order', lazy=True, cascade='all, delete-orphan')
     
+    __table_args__ = (
+        db.UniqueConstraint('buyer_id', 'idempotency_key', name='uq_orders_buyer_idempotency_key'),
+        # Keyset pagination of a buyer's order history, newest first
+        db.Index('ix_orders_buyer_created_id', 'buyer_id', 'created_at', 'id'),
+    )
+    
     def __repr__(self):
         return f'<Order {self.order_number}>'
 
@@ -103,12 +128,155 @@ class OrderItem(db.Model):
     total_price = db.Column(db.Float, nullable=False)
     
     # Foreign keys
-    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False)
-    crop_id = db.Column(db.Integer, db.ForeignKey('crops.id'), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False, index=True)
+    crop_id = db.Column(db.Integer, db.ForeignKey('crops.id'), nullable=False, index=True)
     
     def __repr__(self):
         return f'<OrderItem {self.id}>'
 
+class CropPrice(db.Model):
+    """A crop listing's price from the moment it was set"""
+    __tablename__ = 'crop_prices'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name_key = db.Column(db.String(100), nullable=False)  # lower-cased crop name
+    district = db.Column(db.String(100), nullable=False)
+    unit = db.Column(db.String(20), nullable=False)
+    price_per_unit = db.Column(db.Float, nullable=False)
+    recorded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    # Foreign keys
+    crop_id = db.Column(db.Integer, db.ForeignKey('crops.id'), nullable=False, index=True)
+    
+    # Relationships
+    crop = db.relationship('Crop')
+    
+    __table_args__ = (
+        # Market index lookups by crop name, optionally per district, over a time window
+        db.Index('ix_crop_prices_name_unit_recorded', 'name_key', 'unit', 'recorded_at'),
+    )
+    
+    def __repr__(self):
+        return f'<CropPrice {self.name_key} {self.price_per_unit}>'
+
+class LatencyBucket(db.Model):
+    """Count of consultation latencies falling in one bucket of a latency sketch"""
+    __tablename__ = 'latency_buckets'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    metric = db.Column(db.String(20), nullable=False)  # claim, resolution
+    scope = db.Column(db.String(20), nullable=False)  # all, category, consultant
+    scope_key = db.Column(db.String(50), nullable=False)  # category name or consultant id; '' for all
+    bucket = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        db.UniqueConstraint('metric', 'scope', 'scope_key', 'bucket', name='uq_latency_buckets_metric_scope_bucket'),
+    )
+    
+    def __repr__(self):
+        return f'<LatencyBucket {self.metric} {self.scope}:{self.scope_key} {self.bucket}>'
+
+class SalesRollup(db.Model):
+    """Daily sales of one crop, kept current as orders change"""
+    __tablename__ = 'sales_rollups'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)  # day the orders were placed (UTC)
+    quantity = db.Column(db.Float, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    paid_revenue = db.Column(db.Float, nullable=False, default=0)
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    
+    # Foreign keys
+    farmer_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    crop_id = db.Column(db.Integer, db.ForeignKey('crops.id'), nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('farmer_id', 'day', 'crop_id', name='uq_sales_rollups_farmer_day_crop'),
+    )
+    
+    def __repr__(self):
+        return f'<SalesRollup {self.farmer_id} {self.crop_id} {self.day}>'
+
+class OrderRollup(db.Model):
+    """Orders a farmer received on one day, each counted once however many of their crops it has"""
+    __tablename__ = 'order_rollups'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)  # day the orders were placed (UTC)
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    
+    # Foreign keys
+    farmer_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('farmer_id', 'day', name='uq_order_rollups_farmer_day'),
+    )
+    
+    def __repr__(self):
+        return f'<OrderRollup {self.farmer_id} {self.day}>'
+
+class Cart(db.Model):
+    """Server-side shopping cart, one per buyer"""
+    __tablename__ = 'carts'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Foreign keys
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), unique=True, nullable=False)
+    
+    # Relationships
+    items = db.relationship('CartItem', backref='cart', lazy=True, cascade='all, delete-orphan')
+    
+    def __repr__(self):
+        return f'<Cart {self.id}>'
+
+class CartItem(db.Model):
+    """Cart line: a quantity of one crop"""
+    __tablename__ = 'cart_items'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    quantity = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Foreign keys
+    cart_id = db.Column(db.Integer, db.ForeignKey('carts.id'), nullable=False)
+    crop_id = db.Column(db.Integer, db.ForeignKey('crops.id'), nullable=False)
+    
+    # Relationships
+    crop = db.relationship('Crop')
+    
+    __table_args__ = (
+        db.UniqueConstraint('cart_id', 'crop_id', name='uq_cart_items_cart_crop'),
+    )
+    
+    def __repr__(self):
+        return f'<CartItem {self.id}>'
+
+class StockHold(db.Model):
+    """Stock set aside for a buyer's cart line until it expires"""
+    __tablename__ = 'stock_holds'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    quantity = db.Column(db.Float, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Foreign keys
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    crop_id = db.Column(db.Integer, db.ForeignKey('crops.id'), nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'crop_id', name='uq_stock_holds_user_crop'),
+    )
+    
+    def __repr__(self):
+        return f'<StockHold {self.id}>'
+
 class Consultation(db.Model):
     """Consultation model for expert advice"""
     __tablename__ = 'consultations'
@@ -119,15 +287,31 @@ class Consultation(db.Model):
     category = db.Column(db.String(50), nullable=False)  # crop_management, pest_control, soil_health, etc.
     status = db.Column(db.String(20), nullable=False, default='pending')  # pending, in_progress, completed, cancelled
     priority = db.Column(db.String(10), nullable=False, default='medium')  # low, medium, high, urgent
+    priority_rank = db.Column(db.Integer, nullable=False, default=2, server_default='2')  # queue order of priority
     response = db.Column(db.Text, nullable=True)
     rating = db.Column(db.Integer, nullable=True)  # 1-5 stars
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    claimed_at = db.Column(db.DateTime, nullable=True)  # when a consultant took it on
     completed_at = db.Column(db.DateTime, nullable=True)
     
     # Foreign keys
-    farmer_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    consultant_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    farmer_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    consultant_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True, index=True)
+    
+    __table_args__ = (
+        # The unclaimed queue: pending without a consultant, most urgent first, then oldest first
+        db.Index('ix_consultations_queue', 'status', 'consultant_id', 'priority_rank', 'created_at', 'id'),
+    )
+    
+    @validates('priority')
+    def validate_priority(self, key, priority):
+        """Keep priority_rank in step with priority"""
+        if priority in CONSULTATION_PRIORITIES:
+            self.priority_rank = CONSULTATION_PRIORITIES.index(priority)
+        else:
+            self.priority_rank = len(CONSULTATION_PRIORITIES)
+        return priority
     
     def __repr__(self):
         return f'<Consultation {self.title}>'
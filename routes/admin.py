@@ -1,8 +1,13 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context
 from flask_login import login_required, current_user
 from models import User, Crop, Order, Consultation, db
 from datetime import datetime, timedelta
 from sqlalchemy import func
+from services import order_export
+from services.order_export import EXPORT_FORMATS, parse_export_filters
+from services.routing import ROUTING_BATCH, route_pending
+from services.sla import METRICS, latency_percentiles
+from services.search import search_crops
 
 bp = Blueprint('admin', __name__, url_prefix='/admin')
 
@@ -169,16 +174,12 @@ def crops():
     query = Crop.query
     
     if search:
-        query = query.filter(
-            (Crop.name.contains(search)) |
-            (Crop.description.contains(search)) |
-            (Crop.location.contains(search))
-        )
+        query = search_crops(query, search)
     
     if organic_filter == 'yes':
-        query = query.filter_by(is_organic=True)
+        query = query.filter(Crop.is_organic == True)
     elif organic_filter == 'no':
-        query = query.filter_by(is_organic=False)
+        query = query.filter(Crop.is_organic == False)
     
     crops = query.order_by(Crop.created_at.desc()).paginate(
         page=page, per_page=20, error_out=False
@@ -222,6 +223,20 @@ def orders():
     
     return render_template('admin/orders.html', orders=orders, status_filter=status_filter, payment_filter=payment_filter)
 
+@bp.route('/orders/export')
+@login_required
+@admin_required
+def export_orders():
+    """Download all orders as CSV or NDJSON"""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        fmt = 'csv'
+    
+    rows = order_export.export_orders(fmt, **parse_export_filters(request.args))
+    filename = f"orders-{datetime.utcnow().strftime('%Y-%m-%d')}.{fmt}"
+    return Response(stream_with_context(rows), mimetype=EXPORT_FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
 @bp.route('/orders/<int:order_id>/update-status', methods=['POST'])
 @login_required
 @admin_required
@@ -271,7 +286,9 @@ def assign_consultation(consultation_id):
     if consultant_id:
         consultant = User.query.filter_by(id=consultant_id, role='consultant').first()
         if consultant:
-            consultation.consultant_id = consultant_id
+            if consultation.consultant_id != consultant.id:
+                consultation.claimed_at = datetime.utcnow()
+            consultation.consultant_id = consultant.id
             consultation.status = 'in_progress'
             db.session.commit()
             flash(f'Consultation assigned to {consultant.get_full_name()}!', 'success')
@@ -279,12 +296,67 @@ def assign_consultation(consultation_id):
             flash('Invalid consultant selected!', 'error')
     else:
         consultation.consultant_id = None
+        consultation.claimed_at = None
         consultation.status = 'pending'
         db.session.commit()
         flash('Consultation unassigned!', 'success')
     
     return redirect(url_for('admin.consultations'))
 
+@bp.route('/consultations/route', methods=['POST'])
+@login_required
+@admin_required
+def route_consultations():
+    """Assign every waiting consultation to a consultant now instead of on the next routing run"""
+    assigned = {}
+    while True:
+        batch = route_pending(min_age=None)
+        assigned.update(batch)
+        if len(batch) < ROUTING_BATCH:
+            break
+    
+    if assigned:
+        flash(f'{len(assigned)} consultations assigned automatically!', 'success')
+    else:
+        flash('No waiting consultations could be assigned.', 'info')
+    return redirect(url_for('admin.consultations'))
+
+@bp.route('/consultations/sla')
+@login_required
+@admin_required
+def consultation_sla():
+    """Claim and resolution latency percentiles of consultations"""
+    scope = request.args.get('scope', 'category')
+    if scope not in ('category', 'consultant'):
+        scope = 'category'
+    
+    overall = {metric: latency_percentiles(metric, 'all').get('') for metric in METRICS}
+    by_scope = {metric: latency_percentiles(metric, scope) for metric in METRICS}
+    
+    # One row per category or consultant seen in either metric
+    keys = sorted(set(by_scope['claim']) | set(by_scope['resolution']))
+    labels = {key: key.replace('_', ' ').title() for key in keys}
+    if scope == 'consultant':
+        consultants = User.query.filter(User.id.in_([int(key) for key in keys])).all()
+        labels.update({str(consultant.id): consultant.get_full_name() for consultant in consultants})
+        keys.sort(key=lambda key: labels[key])
+    
+    return render_template('admin/consultation_sla.html', scope=scope, overall=overall,
+                           by_scope=by_scope, keys=keys, labels=labels)
+
+@bp.app_template_filter('duration')
+def duration(seconds):
+    """Format a latency in seconds as e.g. '45s', '12m', '3.5h' or '2.1d'"""
+    if seconds is None:
+        return '-'
+    if seconds < 60:
+        return f'{seconds:.0f}s'
+    if seconds < 3600:
+        return f'{seconds / 60:.0f}m'
+    if seconds < 86400:
+        return f'{seconds / 3600:.1f}h'
+    return f'{seconds / 86400:.1f}d'
+
 @bp.route('/reports')
 @login_required
 @admin_required
@@ -2,6 +2,7 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash,
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import check_password_hash
 from models import User, db
+from services.cart import merge_session_cart
 from datetime import datetime
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
@@ -66,6 +67,8 @@ def login():
         if user and check_password_hash(user.password_hash, password):
             if user.is_active:
                 login_user(user, remember=remember)
+                if user.role == 'buyer':
+                    merge_session_cart(user, session)
                 flash(f'Welcome back, {user.first_name}!', 'success')
                 
                 # Redirect based on role
@@ -1,11 +1,65 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, abort, Response, stream_with_context
 from flask_login import login_required, current_user
+from sqlalchemy import case, func
+from sqlalchemy.orm import joinedload, selectinload
 from models import Crop, Order, OrderItem, User, db
+from services import order_export
+from services.cart import load_cart, add_items, set_items, clear_cart, cart_totals, cart_lines
+from services.facets import crop_facets, parse_facet_selection, filter_by_facets
+from services.geo import crop_ids_within, geocode, nearest_crops, place_names
+from services.holds import holds_enabled, held_quantities, set_holds
+from services.inventory import InsufficientStock
+from services.order_export import EXPORT_FORMATS, ORDER_STATUSES, parse_export_filters
+from services.orders import place_order, cancel_order as cancel_placed_order, find_order_by_key, new_idempotency_key
+from services.pagination import keyset_page
+from services.recommendations import bought_together, cart_suggestions
+from services.search import match_crops
 from datetime import datetime
-import uuid
 
 bp = Blueprint('buyer', __name__, url_prefix='/buyer')
 
+CROPS_PER_PAGE = 24
+
+ORDERS_PER_PAGE = 20
+
+# Orders shown on the dashboard
+RECENT_ORDERS = 5
+
+# Search radius choices for "crops near me", in km
+NEAR_RADII = [10, 25, 50, 100, 250]
+
+def wants_json():
+    """Whether the request came from the AJAX client in main.js"""
+    return request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+
+def cart_response(message, crops=(), errors=()):
+    """Compact JSON reply for cart changes: changed lines, rejected lines and cart totals"""
+    count, total_amount = cart_totals(current_user)
+    quantities = cart_lines(current_user, [crop.id for crop in crops])
+    lines = []
+    for crop in crops:
+        quantity = quantities.get(crop.id, 0)
+        lines.append({
+            'crop_id': crop.id,
+            'quantity': quantity,
+            'total': crop.price_per_unit * quantity
+        })
+    return jsonify({
+        'success': True,
+        'message': message,
+        'lines': lines,
+        'errors': [{'crop_id': crop_id, 'message': error} for crop_id, error in errors],
+        'cart_count': count,
+        'total_amount': total_amount
+    })
+
+def cart_error(message, status=400, errors=()):
+    return jsonify({
+        'success': False,
+        'message': message,
+        'errors': [{'crop_id': crop_id, 'message': error} for crop_id, error in errors]
+    }), status
+
 @bp.route('/dashboard')
 @login_required
 def dashboard():
@@ -14,26 +68,36 @@ def dashboard():
         flash('Access denied. Buyer role required.', 'error')
         return redirect(url_for('index'))
     
-    # Get buyer's orders
-    orders = Order.query.filter_by(buyer_id=current_user.id).order_by(Order.created_at.desc()).all()
+    # Statistics in one aggregate query
+    total_orders, pending_orders, completed_orders, total_spent = db.session.query(
+        func.count(Order.id),
+        func.sum(case((Order.status == 'pending', 1), else_=0)),
+        func.sum(case((Order.status == 'delivered', 1), else_=0)),
+        func.sum(case((Order.payment_status == 'paid', Order.total_amount), else_=0))
+    ).filter(Order.buyer_id == current_user.id).one()
+    
+    # Only the most recent orders are shown
+    orders = (Order.query
+              .filter_by(buyer_id=current_user.id)
+              .options(selectinload(Order.items))
+              .order_by(Order.created_at.desc(), Order.id.desc())
+              .limit(RECENT_ORDERS)
+              .all())
     
     # Get featured crops (recent active crops)
     featured_crops = Crop.query.filter_by(is_active=True).order_by(Crop.created_at.desc()).limit(6).all()
     
-    # Calculate statistics
-    total_orders = len(orders)
-    pending_orders = len([o for o in orders if o.status == 'pending'])
-    completed_orders = len([o for o in orders if o.status == 'delivered'])
-    total_spent = sum([o.total_amount for o in orders if o.payment_status == 'paid'])
+    cart_count, _ = cart_totals(current_user)
     
     return render_template('buyer/dashboard.html', 
                          orders=orders,
                          featured_crops=featured_crops,
+                         cart_count=cart_count,
                          stats={
                              'total_orders': total_orders,
-                             'pending_orders': pending_orders,
-                             'completed_orders': completed_orders,
-                             'total_spent': total_spent
+                             'pending_orders': pending_orders or 0,
+                             'completed_orders': completed_orders or 0,
+                             'total_spent': total_spent or 0
                          })
 
 @bp.route('/crops')
@@ -49,23 +113,64 @@ def browse_crops():
     category = request.args.get('category', '')
     location = request.args.get('location', '')
     organic_only = request.args.get('organic_only') == 'on'
+    cursor = request.args.get('cursor', '')
+    near = request.args.get('near', '')
+    radius = request.args.get('radius', 50, type=int)
     
     # Build query
-    query = Crop.query.filter_by(is_active=True)
+    query = Crop.query.filter_by(is_active=True).options(joinedload(Crop.farmer))
+    
+    # Newest first, or best match first when searching
+    sort_keys = [(Crop.created_at, True), (Crop.id, True)]
     
     if search:
-        query = query.filter(Crop.name.contains(search) | Crop.description.contains(search))
+        query, rank_key = match_crops(query, search)
+        if rank_key is not None:
+            sort_keys = [rank_key, (Crop.id, True)]
     
     if location:
         query = query.filter(Crop.location.contains(location))
     
-    if organic_only:
-        query = query.filter_by(is_organic=True)
+    # Facet filters (organic, district, unit, crop name, price range)
+    unfaceted = query
+    selected_facets = parse_facet_selection(request.args)
+    query = filter_by_facets(query, selected_facets)
+    
+    # Nearest first within a radius of a place, or of the buyer's own address
+    center = None
+    if near == 'me':
+        if current_user.latitude is not None:
+            center = (current_user.latitude, current_user.longitude)
+        else:
+            flash('We could not locate your address. Please pick a district instead.', 'warning')
+    elif near:
+        center = geocode(near)
+        if center is None:
+            flash(f'Unknown place "{near}". Please pick a district or upazila.', 'warning')
+    
+    # Facet counts cover the crops left by the search, location and distance filters
+    facet_scope = None
+    if search or location or center:
+        facet_scope = {crop_id for crop_id, in unfaceted.with_entities(Crop.id)}
+        if center:
+            facet_scope &= crop_ids_within(center[0], center[1], radius)
+    
+    distances = {}
+    if center:
+        crops, distances, next_cursor = nearest_crops(query, center[0], center[1], radius,
+                                                      cursor=cursor, per_page=CROPS_PER_PAGE)
+    else:
+        crops, next_cursor = keyset_page(query, sort_keys, cursor=cursor, per_page=CROPS_PER_PAGE)
     
-    crops = query.order_by(Crop.created_at.desc()).all()
+    # Arguments of the current view, for building facet and page links
+    facet_args = {key: value for key, value in request.args.items() if key != 'cursor'}
     
-    return render_template('buyer/browse_crops.html', crops=crops, 
-                         search=search, location=location, organic_only=organic_only)
+    return render_template('buyer/browse_crops.html', crops=crops, next_cursor=next_cursor,
+                         search=search, location=location, organic_only=organic_only,
+                         facets=crop_facets.counts(selected_facets, facet_scope),
+                         selected_facets=selected_facets, facet_args=facet_args,
+                         near=near, radius=radius, radii=NEAR_RADII, distances=distances,
+                         place_names=place_names(), cart_count=cart_totals(current_user)[0])
 
 @bp.route('/crops/<int:crop_id>')
 @login_required
@@ -76,7 +181,7 @@ def crop_details(crop_id):
         return redirect(url_for('index'))
     
     crop = Crop.query.filter_by(id=crop_id, is_active=True).first_or_404()
-    return render_template('buyer/crop_details.html', crop=crop)
+    return render_template('buyer/crop_details.html', crop=crop, suggestions=bought_together(crop))
 
 @bp.route('/cart')
 @login_required
@@ -86,53 +191,51 @@ def cart():
         flash('Access denied. Buyer role required.', 'error')
         return redirect(url_for('index'))
     
-    # Get cart from session
-    cart = session.get('cart', {})
-    cart_items = []
-    total_amount = 0
-    
-    for crop_id, quantity in cart.items():
-        crop = Crop.query.filter_by(id=crop_id, is_active=True).first()
-        if crop and quantity > 0:
-            item_total = crop.price_per_unit * quantity
-            cart_items.append({
-                'crop': crop,
-                'quantity': quantity,
-                'total': item_total
-            })
-            total_amount += item_total
-    
-    return render_template('buyer/cart.html', cart_items=cart_items, total_amount=total_amount)
+    cart_items, total_amount = load_cart(current_user)
+    suggestions = cart_suggestions([item['crop'] for item in cart_items])
+    
+    return render_template('buyer/cart.html', cart_items=cart_items, total_amount=total_amount,
+                           suggestions=suggestions)
 
 @bp.route('/cart/add', methods=['POST'])
 @login_required
 def add_to_cart():
     """Add item to cart"""
     if current_user.role != 'buyer':
+        if wants_json():
+            return cart_error('Access denied. Buyer role required.', 403)
         flash('Access denied. Buyer role required.', 'error')
         return redirect(url_for('index'))
     
     crop_id = int(request.form['crop_id'])
     quantity = float(request.form['quantity'])
     
-    crop = Crop.query.filter_by(id=crop_id, is_active=True).first_or_404()
+    crop = Crop.query.filter_by(id=crop_id, is_active=True).first()
+    if crop is None:
+        if wants_json():
+            return cart_error('This crop is no longer available.', 404)
+        abort(404)
     
-    if quantity > crop.quantity_available:
-        flash(f'Only {crop.quantity_available} {crop.unit} available!', 'error')
+    if quantity > crop.get_unheld_quantity():
+        if wants_json():
+            return cart_error(f'Only {crop.get_unheld_quantity()} {crop.unit} available!')
+        flash(f'Only {crop.get_unheld_quantity()} {crop.unit} available!', 'error')
         return redirect(url_for('buyer.crop_details', crop_id=crop_id))
     
-    # Initialize cart if not exists
-    if 'cart' not in session:
-        session['cart'] = {}
+    # Hold the new line quantity, then add to cart
+    if holds_enabled():
+        if set_holds(current_user.id, {crop_id: cart_lines(current_user, [crop_id]).get(crop_id, 0) + quantity}):
+            if wants_json():
+                return cart_error(f'{crop.name} no longer has {quantity} {crop.unit} available!', 409)
+            flash(f'{crop.name} no longer has {quantity} {crop.unit} available!', 'error')
+            return redirect(url_for('buyer.crop_details', crop_id=crop_id))
+    add_items(current_user, {crop_id: quantity})
     
-    # Add to cart
-    if str(crop_id) in session['cart']:
-        session['cart'][str(crop_id)] += quantity
-    else:
-        session['cart'][str(crop_id)] = quantity
+    message = f'Added {quantity} {crop.unit} of {crop.name} to cart!'
+    if wants_json():
+        return cart_response(message, [crop])
     
-    session.modified = True
-    flash(f'Added {quantity} {crop.unit} of {crop.name} to cart!', 'success')
+    flash(message, 'success')
     return redirect(url_for('buyer.cart'))
 
 @bp.route('/cart/update', methods=['POST'])
@@ -140,23 +243,53 @@ def add_to_cart():
 def update_cart():
     """Update cart item quantity"""
     if current_user.role != 'buyer':
+        if wants_json():
+            return cart_error('Access denied. Buyer role required.', 403)
         flash('Access denied. Buyer role required.', 'error')
         return redirect(url_for('index'))
     
-    crop_id = request.form['crop_id']
-    quantity = float(request.form['quantity'])
-    
-    if quantity <= 0:
-        # Remove from cart
-        session['cart'].pop(crop_id, None)
-    else:
-        crop = Crop.query.filter_by(id=crop_id, is_active=True).first()
-        if crop and quantity <= crop.quantity_available:
-            session['cart'][crop_id] = quantity
+    # A single line (crop_id, quantity) or many lines (quantity_<crop_id>) at once
+    updates = {}
+    if 'crop_id' in request.form:
+        updates[int(request.form['crop_id'])] = float(request.form['quantity'])
+    for key, value in request.form.items():
+        if key.startswith('quantity_'):
+            updates[int(key[len('quantity_'):])] = float(value)
+    
+    crops = {crop.id: crop for crop in Crop.query.filter(Crop.id.in_(updates.keys()), Crop.is_active == True)}
+    
+    # Stock the buyer already holds is available to them on top of the rest
+    held = held_quantities(current_user.id, list(crops.keys()))
+    
+    quantities = {}
+    errors = []
+    for crop_id, quantity in updates.items():
+        crop = crops.get(crop_id)
+        if quantity <= 0 or crop is None:
+            # Remove from cart
+            quantities[crop_id] = 0
+        elif quantity <= crop.get_unheld_quantity() + held.get(crop_id, 0):
+            quantities[crop_id] = quantity
         else:
-            flash(f'Only {crop.quantity_available} {crop.unit} available!', 'error')
+            errors.append((crop_id, f'Only {crop.get_unheld_quantity() + held.get(crop_id, 0)} {crop.unit} of {crop.name} available!'))
+    
+    if holds_enabled() or held:
+        # Lines that lost their stock to another buyer since it was checked
+        for crop_id in set_holds(current_user.id, quantities):
+            del quantities[crop_id]
+            errors.append((crop_id, f'{crops[crop_id].name} no longer has enough stock available!'))
+    
+    set_items(current_user, quantities)
     
-    session.modified = True
+    # Valid lines are saved even when others are rejected; errors lists the rejected ones
+    if wants_json():
+        if errors and not quantities:
+            return cart_error(' '.join(error for _, error in errors), errors=errors)
+        message = 'Cart updated, but some lines could not be changed.' if errors else 'Cart updated!'
+        return cart_response(message, [crops[crop_id] for crop_id in quantities if crop_id in crops], errors)
+    
+    for _, error in errors:
+        flash(error, 'error')
     return redirect(url_for('buyer.cart'))
 
 @bp.route('/cart/remove/<int:crop_id>', methods=['POST'])
@@ -164,11 +297,24 @@ def update_cart():
 def remove_from_cart(crop_id):
     """Remove item from cart"""
     if current_user.role != 'buyer':
+        if wants_json():
+            return cart_error('Access denied. Buyer role required.', 403)
         flash('Access denied. Buyer role required.', 'error')
         return redirect(url_for('index'))
     
-    session['cart'].pop(str(crop_id), None)
-    session.modified = True
+    set_holds(current_user.id, {crop_id: 0})
+    set_items(current_user, {crop_id: 0})
+    
+    if wants_json():
+        count, total_amount = cart_totals(current_user)
+        return jsonify({
+            'success': True,
+            'message': 'Item removed from cart!',
+            'lines': [{'crop_id': crop_id, 'quantity': 0, 'total': 0}],
+            'cart_count': count,
+            'total_amount': total_amount
+        })
+    
     flash('Item removed from cart!', 'success')
     return redirect(url_for('buyer.cart'))
 
@@ -180,8 +326,16 @@ def checkout():
         flash('Access denied. Buyer role required.', 'error')
         return redirect(url_for('index'))
     
-    cart = session.get('cart', {})
-    if not cart:
+    # A retried submit replays the order it already created
+    idempotency_key = request.form.get('idempotency_key', '')[:64]
+    if request.method == 'POST':
+        existing = find_order_by_key(current_user.id, idempotency_key)
+        if existing:
+            flash(f'Order placed successfully! Order number: {existing.order_number}', 'success')
+            return redirect(url_for('buyer.order_details', order_id=existing.id))
+    
+    cart_items, total_amount = load_cart(current_user)
+    if not cart_items:
         flash('Your cart is empty!', 'error')
         return redirect(url_for('buyer.cart'))
     
@@ -190,81 +344,24 @@ def checkout():
         payment_method = request.form['payment_method']
         notes = request.form.get('notes', '')
         
-        # Create order
-        order_number = f"ORD-{datetime.now().strftime('%Y%m%d')}-{str(uuid.uuid4())[:8].upper()}"
-        total_amount = 0
-        order_items = []
-        
-        # Calculate total and create order items
-        for crop_id, quantity in cart.items():
-            crop = Crop.query.filter_by(id=crop_id, is_active=True).first()
-            if crop and quantity > 0:
-                if quantity > crop.quantity_available:
-                    flash(f'Only {crop.quantity_available} {crop.unit} of {crop.name} available!', 'error')
-                    return redirect(url_for('buyer.cart'))
-                
-                item_total = crop.price_per_unit * quantity
-                total_amount += item_total
-                
-                order_items.append({
-                    'crop': crop,
-                    'quantity': quantity,
-                    'unit_price': crop.price_per_unit,
-                    'total_price': item_total
-                })
-        
-        # Create order
-        order = Order(
-            order_number=order_number,
-            total_amount=total_amount,
-            shipping_address=shipping_address,
-            payment_method=payment_method,
-            notes=notes,
-            buyer_id=current_user.id
-        )
-        
-        db.session.add(order)
-        db.session.flush()  # Get order ID
-        
-        # Create order items
-        for item in order_items:
-            order_item = OrderItem(
-                order_id=order.id,
-                crop_id=item['crop'].id,
-                quantity=item['quantity'],
-                unit_price=item['unit_price'],
-                total_price=item['total_price']
-            )
-            db.session.add(order_item)
-            
-            # Update crop quantity
-            item['crop'].quantity_available -= item['quantity']
-        
-        db.session.commit()
+        # Create order, reserving stock for every item
+        try:
+            order = place_order(current_user.id, cart_items, total_amount,
+                                shipping_address, payment_method, notes,
+                                idempotency_key=idempotency_key or None)
+        except InsufficientStock as e:
+            crop = Crop.query.get(e.crop_id)
+            flash(f'Only {crop.get_unheld_quantity()} {crop.unit} of {crop.name} available!', 'error')
+            return redirect(url_for('buyer.cart'))
         
         # Clear cart
-        session['cart'] = {}
-        session.modified = True
+        clear_cart(current_user)
         
-        flash(f'Order placed successfully! Order number: {order_number}', 'success')
+        flash(f'Order placed successfully! Order number: {order.order_number}', 'success')
         return redirect(url_for('buyer.order_details', order_id=order.id))
     
-    # Calculate cart total
-    cart_items = []
-    total_amount = 0
-    
-    for crop_id, quantity in cart.items():
-        crop = Crop.query.filter_by(id=crop_id, is_active=True).first()
-        if crop and quantity > 0:
-            item_total = crop.price_per_unit * quantity
-            cart_items.append({
-                'crop': crop,
-                'quantity': quantity,
-                'total': item_total
-            })
-            total_amount += item_total
-    
-    return render_template('buyer/checkout.html', cart_items=cart_items, total_amount=total_amount)
+    return render_template('buyer/checkout.html', cart_items=cart_items, total_amount=total_amount,
+                         idempotency_key=new_idempotency_key())
 
 @bp.route('/orders')
 @login_required
@@ -274,8 +371,30 @@ def orders():
         flash('Access denied. Buyer role required.', 'error')
         return redirect(url_for('index'))
     
-    orders = Order.query.filter_by(buyer_id=current_user.id).order_by(Order.created_at.desc()).all()
-    return render_template('buyer/orders.html', orders=orders)
+    query = (Order.query
+             .filter_by(buyer_id=current_user.id)
+             .options(selectinload(Order.items).joinedload(OrderItem.crop)))
+    orders, next_cursor = keyset_page(query, [(Order.created_at, True), (Order.id, True)],
+                                      cursor=request.args.get('cursor', ''), per_page=ORDERS_PER_PAGE)
+    
+    return render_template('buyer/orders.html', orders=orders, next_cursor=next_cursor, statuses=ORDER_STATUSES)
+
+@bp.route('/orders/export')
+@login_required
+def export_orders():
+    """Download order history as CSV or NDJSON"""
+    if current_user.role != 'buyer':
+        flash('Access denied. Buyer role required.', 'error')
+        return redirect(url_for('index'))
+    
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        fmt = 'csv'
+    
+    rows = order_export.export_orders(fmt, buyer_id=current_user.id, **parse_export_filters(request.args))
+    filename = f"orders-{datetime.utcnow().strftime('%Y-%m-%d')}.{fmt}"
+    return Response(stream_with_context(rows), mimetype=EXPORT_FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 @bp.route('/orders/<int:order_id>')
 @login_required
@@ -285,7 +404,10 @@ def order_details(order_id):
         flash('Access denied. Buyer role required.', 'error')
         return redirect(url_for('index'))
     
-    order = Order.query.filter_by(id=order_id, buyer_id=current_user.id).first_or_404()
+    order = (Order.query
+             .filter_by(id=order_id, buyer_id=current_user.id)
+             .options(selectinload(Order.items).joinedload(OrderItem.crop).joinedload(Crop.farmer))
+             .first_or_404())
     return render_template('buyer/order_details.html', order=order)
 
 @bp.route('/orders/<int:order_id>/cancel', methods=['POST'])
@@ -302,13 +424,10 @@ def cancel_order(order_id):
         flash('Cannot cancel order that has been shipped or delivered!', 'error')
         return redirect(url_for('buyer.order_details', order_id=order_id))
     
-    order.status = 'cancelled'
-    
-    # Restore crop quantities
-    for item in order.items:
-        item.crop.quantity_available += item.quantity
-    
-    db.session.commit()
+    # Cancel and restore crop quantities
+    if not cancel_placed_order(order):
+        flash('This order can no longer be cancelled.', 'error')
+        return redirect(url_for('buyer.order_details', order_id=order_id))
     
     flash('Order cancelled successfully!', 'success')
     return redirect(url_for('buyer.orders'))
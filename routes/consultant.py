@@ -1,10 +1,42 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
 from flask_login import login_required, current_user
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
 from models import Consultation, User, db
+from services.consultation_queue import MAX_CLAIM_BATCH, QUEUE_KEYS, claim, claim_next, unclaimed_query
+from services.consultations import category_stats as consultation_category_stats
+from services.pagination import keyset_page
+from services.similar_questions import similar_questions
 from datetime import datetime
 
 bp = Blueprint('consultant', __name__, url_prefix='/consultant')
 
+# Entries shown in each dashboard list
+RECENT_CONSULTATIONS = 5
+RECENT_AVAILABLE = 3
+
+AVAILABLE_PER_PAGE = 20
+
+# Answered questions shown while responding
+SIMILAR_QUESTIONS = 5
+
+def consultation_stats(consultant_id):
+    """Consultation counts per status and the average rating, from one GROUP BY query"""
+    rows = (db.session.query(Consultation.status, func.count(Consultation.id),
+                             func.count(Consultation.rating), func.sum(Consultation.rating))
+            .filter(Consultation.consultant_id == consultant_id)
+            .group_by(Consultation.status)
+            .all())
+    
+    by_status = {status: count for status, count, _, _ in rows}
+    rated = sum(rated for _, _, rated, _ in rows)
+    rating_total = sum(total or 0 for _, _, _, total in rows)
+    return {
+        'total': sum(by_status.values()),
+        'by_status': by_status,
+        'avg_rating': round(rating_total / rated, 1) if rated else 0
+    }
+
 @bp.route('/dashboard')
 @login_required
 def dashboard():
@@ -13,31 +45,32 @@ def dashboard():
         flash('Access denied. Consultant role required.', 'error')
         return redirect(url_for('index'))
     
-    # Get consultations assigned to this consultant
-    consultations = Consultation.query.filter_by(consultant_id=current_user.id).order_by(Consultation.created_at.desc()).all()
-    
-    # Get pending consultations (not yet assigned)
-    pending_consultations = Consultation.query.filter_by(consultant_id=None, status='pending').order_by(Consultation.created_at.desc()).all()
+    stats = consultation_stats(current_user.id)
     
-    # Calculate statistics
-    total_consultations = len(consultations)
-    pending_count = len([c for c in consultations if c.status == 'pending'])
-    in_progress_count = len([c for c in consultations if c.status == 'in_progress'])
-    completed_count = len([c for c in consultations if c.status == 'completed'])
+    # Only the most recent consultations are shown
+    consultations = (Consultation.query
+                     .filter_by(consultant_id=current_user.id)
+                     .order_by(Consultation.created_at.desc(), Consultation.id.desc())
+                     .limit(RECENT_CONSULTATIONS)
+                     .all())
     
-    # Calculate average rating
-    rated_consultations = [c for c in consultations if c.rating is not None]
-    avg_rating = sum([c.rating for c in rated_consultations]) / len(rated_consultations) if rated_consultations else 0
+    # The head of the unclaimed queue and how long it is
+    pending_consultations = (unclaimed_query()
+                             .order_by(*[column for column, _ in QUEUE_KEYS])
+                             .limit(RECENT_AVAILABLE)
+                             .all())
+    available_count = unclaimed_query().count()
     
     return render_template('consultant/dashboard.html', 
                          consultations=consultations,
                          pending_consultations=pending_consultations,
+                         available_count=available_count,
                          stats={
-                             'total_consultations': total_consultations,
-                             'pending_count': pending_count,
-                             'in_progress_count': in_progress_count,
-                             'completed_count': completed_count,
-                             'avg_rating': round(avg_rating, 1)
+                             'total_consultations': stats['total'],
+                             'pending_count': stats['by_status'].get('pending', 0),
+                             'in_progress_count': stats['by_status'].get('in_progress', 0),
+                             'completed_count': stats['by_status'].get('completed', 0),
+                             'avg_rating': stats['avg_rating']
                          })
 
 @bp.route('/consultations')
@@ -59,8 +92,14 @@ def available_consultations():
         flash('Access denied. Consultant role required.', 'error')
         return redirect(url_for('index'))
     
-    consultations = Consultation.query.filter_by(consultant_id=None, status='pending').order_by(Consultation.created_at.desc()).all()
-    return render_template('consultant/available_consultations.html', consultations=consultations)
+    consultations, next_cursor = keyset_page(
+        unclaimed_query().options(joinedload(Consultation.farmer)),
+        QUEUE_KEYS,
+        cursor=request.args.get('cursor'),
+        per_page=AVAILABLE_PER_PAGE
+    )
+    return render_template('consultant/available_consultations.html', consultations=consultations,
+                           next_cursor=next_cursor, max_claim_batch=MAX_CLAIM_BATCH)
 
 @bp.route('/consultations/<int:consultation_id>/claim', methods=['POST'])
 @login_required
@@ -70,15 +109,34 @@ def claim_consultation(consultation_id):
         flash('Access denied. Consultant role required.', 'error')
         return redirect(url_for('index'))
     
-    consultation = Consultation.query.filter_by(id=consultation_id, consultant_id=None, status='pending').first_or_404()
-    
-    consultation.consultant_id = current_user.id
-    consultation.status = 'in_progress'
-    db.session.commit()
+    if not claim(current_user.id, consultation_id):
+        flash('This consultation has already been claimed or is no longer available.', 'warning')
+        return redirect(url_for('consultant.available_consultations'))
     
     flash('Consultation claimed successfully!', 'success')
     return redirect(url_for('consultant.consultation_details', consultation_id=consultation_id))
 
+@bp.route('/consultations/claim-next', methods=['POST'])
+@login_required
+def claim_next_consultations():
+    """Claim the next consultations from the head of the queue"""
+    if current_user.role != 'consultant':
+        flash('Access denied. Consultant role required.', 'error')
+        return redirect(url_for('index'))
+    
+    count = request.form.get('count', 1, type=int)
+    claimed = claim_next(current_user.id, count)
+    
+    if not claimed:
+        flash('There are no consultation requests waiting.', 'info')
+        return redirect(url_for('consultant.available_consultations'))
+    if len(claimed) == 1:
+        flash('Consultation claimed successfully!', 'success')
+        return redirect(url_for('consultant.consultation_details', consultation_id=claimed[0]))
+    
+    flash(f'{len(claimed)} consultations claimed successfully!', 'success')
+    return redirect(url_for('consultant.consultations'))
+
 @bp.route('/consultations/<int:consultation_id>')
 @login_required
 def consultation_details(consultation_id):
@@ -117,7 +175,9 @@ def respond_consultation(consultation_id):
         flash('Consultation response submitted successfully!', 'success')
         return redirect(url_for('consultant.consultation_details', consultation_id=consultation_id))
     
-    return render_template('consultant/respond_consultation.html', consultation=consultation)
+    similar = similar_questions(f'{consultation.title} {consultation.description}',
+                                k=SIMILAR_QUESTIONS, exclude_id=consultation.id)
+    return render_template('consultant/respond_consultation.html', consultation=consultation, similar=similar)
 
 @bp.route('/consultations/<int:consultation_id>/update-status', methods=['POST'])
 @login_required
@@ -148,24 +208,14 @@ def profile():
         flash('Access denied. Consultant role required.', 'error')
         return redirect(url_for('index'))
     
-    # Get consultant's statistics
-    consultations = Consultation.query.filter_by(consultant_id=current_user.id).all()
-    
-    total_consultations = len(consultations)
-    completed_consultations = len([c for c in consultations if c.status == 'completed'])
-    avg_rating = 0
-    
-    if completed_consultations > 0:
-        rated_consultations = [c for c in consultations if c.rating is not None]
-        if rated_consultations:
-            avg_rating = sum([c.rating for c in rated_consultations]) / len(rated_consultations)
+    stats = consultation_stats(current_user.id)
     
     return render_template('consultant/profile.html', 
                          user=current_user,
                          stats={
-                             'total_consultations': total_consultations,
-                             'completed_consultations': completed_consultations,
-                             'avg_rating': round(avg_rating, 1)
+                             'total_consultations': stats['total'],
+                             'completed_consultations': stats['by_status'].get('completed', 0),
+                             'avg_rating': stats['avg_rating']
                          })
 
 @bp.route('/specializations')
@@ -176,23 +226,6 @@ def specializations():
         flash('Access denied. Consultant role required.', 'error')
         return redirect(url_for('index'))
     
-    # Get consultations by category for this consultant
-    consultations = Consultation.query.filter_by(consultant_id=current_user.id).all()
-    
-    # Count consultations by category
-    category_stats = {}
-    for consultation in consultations:
-        category = consultation.category
-        if category not in category_stats:
-            category_stats[category] = {'total': 0, 'completed': 0, 'avg_rating': 0}
-        
-        category_stats[category]['total'] += 1
-        if consultation.status == 'completed':
-            category_stats[category]['completed'] += 1
-            if consultation.rating:
-                # Calculate average rating for this category
-                cat_consultations = [c for c in consultations if c.category == category and c.rating is not None]
-                if cat_consultations:
-                    category_stats[category]['avg_rating'] = sum([c.rating for c in cat_consultations]) / len(cat_consultations)
+    category_stats = consultation_category_stats(current_user.id)
     
     return render_template('consultant/specializations.html', category_stats=category_stats)
@@ -1,12 +1,47 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context, current_app
 from flask_login import login_required, current_user
+from sqlalchemy import distinct, func, select
+from sqlalchemy.orm import joinedload, selectinload
 from models import Crop, Order, OrderItem, Consultation, db
+from services import crop_io
+from services.analytics import weekly_sales
+from services.images import InvalidImage, save_image, schedule_thumbnails
+from services.market import CACHE_SECONDS, market_index
+from services.pagination import keyset_page
+from services.similar_questions import similar_questions
 from datetime import datetime, date
 import os
 from werkzeug.utils import secure_filename
 
 bp = Blueprint('farmer', __name__, url_prefix='/farmer')
 
+# Entries shown in each dashboard list
+RECENT_CROPS = 5
+RECENT_ORDERS = 5
+RECENT_CONSULTATIONS = 3
+
+ORDERS_PER_PAGE = 20
+
+# Report periods offered on the analytics page, in weeks
+ANALYTICS_WEEKS = [4, 12, 26, 52]
+
+# Answered questions suggested while a consultation is typed, and how much of each answer
+SIMILAR_QUESTIONS = 5
+SIMILAR_RESPONSE_CHARS = 400
+
+def farmer_order_ids(farmer_id):
+    """Subquery of the ids of orders containing any of the farmer's crops"""
+    return (select(OrderItem.order_id)
+            .join(Crop, Crop.id == OrderItem.crop_id)
+            .where(Crop.farmer_id == farmer_id))
+
+def save_crop_image(upload):
+    """Store an uploaded crop photo, queue its thumbnails and return its image URL"""
+    root = current_app.config['UPLOAD_FOLDER']
+    digest = save_image(upload.stream, root)
+    schedule_thumbnails(root, digest)
+    return url_for('images.thumbnail', digest=digest, size='large', fmt='jpeg')
+
 @bp.route('/dashboard')
 @login_required
 def dashboard():
@@ -15,21 +50,33 @@ def dashboard():
         flash('Access denied. Farmer role required.', 'error')
         return redirect(url_for('index'))
     
-    # Get farmer's crops
-    crops = Crop.query.filter_by(farmer_id=current_user.id).all()
+    # All statistics in one round trip
+    farmer_crops = Crop.query.filter(Crop.farmer_id == current_user.id)
+    total_crops, active_crops, total_orders, pending_consultations = db.session.query(
+        farmer_crops.with_entities(func.count(Crop.id)).scalar_subquery(),
+        farmer_crops.filter(Crop.is_active == True).with_entities(func.count(Crop.id)).scalar_subquery(),
+        select(func.count(distinct(OrderItem.order_id)))
+            .join(Crop, Crop.id == OrderItem.crop_id)
+            .where(Crop.farmer_id == current_user.id)
+            .scalar_subquery(),
+        select(func.count(Consultation.id))
+            .where(Consultation.farmer_id == current_user.id, Consultation.status == 'pending')
+            .scalar_subquery()
+    ).one()
     
-    # Get orders for farmer's crops
-    crop_ids = [crop.id for crop in crops]
-    orders = Order.query.join(OrderItem).filter(OrderItem.crop_id.in_(crop_ids)).all()
-    
-    # Get consultations
-    consultations = Consultation.query.filter_by(farmer_id=current_user.id).all()
-    
-    # Calculate statistics
-    total_crops = len(crops)
-    active_crops = len([c for c in crops if c.is_active])
-    total_orders = len(orders)
-    pending_consultations = len([c for c in consultations if c.status == 'pending'])
+    # Only the most recent entries are shown
+    crops = farmer_crops.order_by(Crop.created_at.desc()).limit(RECENT_CROPS).all()
+    orders = (Order.query
+              .filter(Order.id.in_(farmer_order_ids(current_user.id)))
+              .options(joinedload(Order.buyer))
+              .order_by(Order.created_at.desc())
+              .limit(RECENT_ORDERS)
+              .all())
+    consultations = (Consultation.query
+                     .filter_by(farmer_id=current_user.id)
+                     .order_by(Consultation.created_at.desc())
+                     .limit(RECENT_CONSULTATIONS)
+                     .all())
     
     return render_template('farmer/dashboard.html', 
                          crops=crops, 
@@ -76,6 +123,15 @@ def add_crop():
         if harvest_date_str:
             harvest_date = datetime.strptime(harvest_date_str, '%Y-%m-%d').date()
         
+        image_url = None
+        upload = request.files.get('image')
+        if upload and upload.filename:
+            try:
+                image_url = save_crop_image(upload)
+            except InvalidImage as e:
+                flash(str(e), 'error')
+                return render_template('farmer/add_crop.html')
+        
         crop = Crop(
             name=name,
             variety=variety,
@@ -86,6 +142,7 @@ def add_crop():
             harvest_date=harvest_date,
             location=location,
             is_organic=is_organic,
+            image_url=image_url,
             farmer_id=current_user.id
         )
         
@@ -97,6 +154,55 @@ def add_crop():
     
     return render_template('farmer/add_crop.html')
 
+@bp.route('/crops/import', methods=['GET', 'POST'])
+@login_required
+def import_crops():
+    """Bulk import crop listings from a CSV or JSON file"""
+    if current_user.role != 'farmer':
+        flash('Access denied. Farmer role required.', 'error')
+        return redirect(url_for('index'))
+    
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if upload is None or not upload.filename:
+            flash('Please choose a file to import.', 'error')
+            return redirect(url_for('farmer.import_crops'))
+        
+        extension = os.path.splitext(secure_filename(upload.filename))[1].lower()
+        if extension not in ('.csv', '.json', '.ndjson', '.jsonl'):
+            flash('Only CSV and JSON files can be imported.', 'error')
+            return redirect(url_for('farmer.import_crops'))
+        
+        fmt = 'csv' if extension == '.csv' else 'json'
+        result = crop_io.import_crops(current_user.id, crop_io.read_records(upload.stream, fmt))
+        
+        if result.imported:
+            flash(f'Imported {result.imported} crops.', 'success')
+        if result.failed:
+            flash(f'{result.failed} rows could not be imported.', 'error')
+        
+        return render_template('farmer/import_crops.html', result=result, fields=crop_io.CROP_FIELDS)
+    
+    return render_template('farmer/import_crops.html', result=None, fields=crop_io.CROP_FIELDS)
+
+@bp.route('/crops/export')
+@login_required
+def export_crops():
+    """Download all crop listings as CSV or JSON"""
+    if current_user.role != 'farmer':
+        flash('Access denied. Farmer role required.', 'error')
+        return redirect(url_for('index'))
+    
+    fmt = request.args.get('format', 'csv')
+    if fmt == 'json':
+        rows, mimetype = crop_io.export_json(current_user.id), 'application/json'
+    else:
+        fmt, rows, mimetype = 'csv', crop_io.export_csv(current_user.id), 'text/csv'
+    
+    filename = f"crops-{date.today().isoformat()}.{fmt}"
+    return Response(stream_with_context(rows), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
 @bp.route('/crops/<int:crop_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_crop(crop_id):
@@ -123,6 +229,17 @@ def edit_crop(crop_id):
         else:
             crop.harvest_date = None
         
+        upload = request.files.get('image')
+        if upload and upload.filename:
+            try:
+                crop.image_url = save_crop_image(upload)
+            except InvalidImage as e:
+                db.session.rollback()
+                flash(str(e), 'error')
+                return redirect(url_for('farmer.edit_crop', crop_id=crop_id))
+        elif 'remove_image' in request.form:
+            crop.image_url = None
+        
         db.session.commit()
         flash('Crop updated successfully!', 'success')
         return redirect(url_for('farmer.crops'))
@@ -152,14 +269,19 @@ def orders():
         flash('Access denied. Farmer role required.', 'error')
         return redirect(url_for('index'))
     
-    # Get farmer's crops
-    crops = Crop.query.filter_by(farmer_id=current_user.id).all()
-    crop_ids = [crop.id for crop in crops]
+    # Orders containing the farmer's crops, once each, newest first
+    query = (Order.query
+             .join(OrderItem, OrderItem.order_id == Order.id)
+             .join(Crop, Crop.id == OrderItem.crop_id)
+             .filter(Crop.farmer_id == current_user.id)
+             .distinct()
+             .options(joinedload(Order.buyer),
+                      selectinload(Order.items).joinedload(OrderItem.crop)))
     
-    # Get orders for these crops
-    orders = Order.query.join(OrderItem).filter(OrderItem.crop_id.in_(crop_ids)).order_by(Order.created_at.desc()).all()
+    orders, next_cursor = keyset_page(query, [(Order.created_at, True), (Order.id, True)],
+                                      cursor=request.args.get('cursor', ''), per_page=ORDERS_PER_PAGE)
     
-    return render_template('farmer/orders.html', orders=orders)
+    return render_template('farmer/orders.html', orders=orders, next_cursor=next_cursor)
 
 @bp.route('/orders/<int:order_id>/update-status', methods=['POST'])
 @login_required
@@ -173,10 +295,11 @@ def update_order_status(order_id):
     new_status = request.form['status']
     
     # Verify this order contains farmer's crops
-    crop_ids = [crop.id for crop in Crop.query.filter_by(farmer_id=current_user.id).all()]
-    order_crop_ids = [item.crop_id for item in order.items]
+    contains_crops = db.session.query(
+        farmer_order_ids(current_user.id).where(OrderItem.order_id == order.id).exists()
+    ).scalar()
     
-    if not any(crop_id in crop_ids for crop_id in order_crop_ids):
+    if not contains_crops:
         flash('Access denied. This order does not contain your crops.', 'error')
         return redirect(url_for('farmer.orders'))
     
@@ -186,6 +309,48 @@ def update_order_status(order_id):
     flash(f'Order status updated to {new_status}!', 'success')
     return redirect(url_for('farmer.orders'))
 
+@bp.route('/analytics')
+@login_required
+def analytics():
+    """Weekly sales per crop"""
+    if current_user.role != 'farmer':
+        flash('Access denied. Farmer role required.', 'error')
+        return redirect(url_for('index'))
+    
+    weeks = request.args.get('weeks', 12, type=int)
+    if weeks not in ANALYTICS_WEEKS:
+        weeks = 12
+    crop_id = request.args.get('crop', type=int)
+    
+    rows, totals = weekly_sales(current_user.id, weeks=weeks, crop_id=crop_id)
+    crops = Crop.query.filter_by(farmer_id=current_user.id).order_by(Crop.name).with_entities(Crop.id, Crop.name).all()
+    
+    return render_template('farmer/analytics.html', rows=rows, totals=totals, crops=crops,
+                           weeks=weeks, weeks_choices=ANALYTICS_WEEKS, crop_id=crop_id)
+
+@bp.route('/market-prices')
+@login_required
+def market_prices():
+    """Recent market prices for a crop name, optionally in one district"""
+    if current_user.role != 'farmer':
+        return jsonify({'success': False, 'message': 'Farmer role required.'}), 403
+    
+    name = request.args.get('name', '').strip()
+    unit = request.args.get('unit', 'kg')
+    district = request.args.get('district', '').strip()
+    if not name:
+        return jsonify({'success': False, 'message': 'Please give a crop name.'}), 400
+    
+    index = market_index(name, unit, district)
+    # Too few listings in the district; fall back to every district
+    if district and index['count'] == 0:
+        index = market_index(name, unit)
+    
+    response = jsonify(index)
+    response.cache_control.private = True
+    response.cache_control.max_age = CACHE_SECONDS
+    return response
+
 @bp.route('/consultations')
 @login_required
 def consultations():
@@ -227,6 +392,23 @@ def add_consultation():
     
     return render_template('farmer/add_consultation.html')
 
+@bp.route('/consultations/similar')
+@login_required
+def similar_consultations():
+    """Answered consultations similar to a question being typed"""
+    if current_user.role != 'farmer':
+        return jsonify({'success': False, 'message': 'Farmer role required.'}), 403
+    
+    matches = similar_questions(request.args.get('q', ''), k=SIMILAR_QUESTIONS)
+    return jsonify({
+        'success': True,
+        'results': [{
+            'title': consultation.title,
+            'category': consultation.category,
+            'response': consultation.response[:SIMILAR_RESPONSE_CHARS]
+        } for consultation in matches]
+    })
+
 @bp.route('/consultations/<int:consultation_id>/rate', methods=['POST'])
 @login_required
 def rate_consultation(consultation_id):
@@ -0,0 +1,31 @@
+from flask import Blueprint, current_app, send_file, url_for, abort
+from services.images import (THUMBNAIL_SIZES, THUMBNAIL_FORMATS, DIGEST_PATTERN,
+                             render_thumbnail, digest_of)
+
+bp = Blueprint('images', __name__, url_prefix='/images')
+
+# Thumbnail URLs change whenever the image does, so browsers may keep them for a year
+CACHE_SECONDS = 365 * 24 * 3600
+
+@bp.route('/<digest>/<size>.<fmt>')
+def thumbnail(digest, size, fmt):
+    """Resized crop photo"""
+    if not DIGEST_PATTERN.match(digest) or size not in THUMBNAIL_SIZES or fmt not in THUMBNAIL_FORMATS:
+        abort(404)
+    
+    path = render_thumbnail(current_app.config['UPLOAD_FOLDER'], digest, size, fmt)
+    if path is None:
+        abort(404)
+    
+    response = send_file(path, mimetype=THUMBNAIL_FORMATS[fmt][1], conditional=True,
+                         etag=f'{digest}-{size}-{fmt}', max_age=CACHE_SECONDS)
+    response.cache_control.immutable = True
+    return response
+
+@bp.app_template_global()
+def crop_image_url(crop, size='card', fmt='jpeg'):
+    """URL of a crop's photo at the given thumbnail size, or None without one"""
+    digest = digest_of(crop.image_url)
+    if digest is None:
+        return crop.image_url or None
+    return url_for('images.thumbnail', digest=digest, size=size, fmt=fmt)
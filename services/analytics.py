@@ -0,0 +1,269 @@
+"""
+Farmer sales analytics from incremental daily rollups.
+
+Every order line adds its quantity, revenue and one order to the
+sales_rollups row of its (farmer, day, crop), and paid orders also add to
+paid_revenue. An order with several of a farmer's crops appears in several
+of those rows, so order_rollups separately counts each order once per
+(farmer, day) for totals across crops. Rows are adjusted in the same
+transaction as the order change that caused them: lines are counted when
+the order is placed, taken back out when it is cancelled or deleted, and
+moved between paid and unpaid when the payment status changes. Reports then
+read a few hundred rollup rows instead of scanning every order line.
+
+ORM changes to orders are picked up by a before_flush listener; code that
+changes orders with bulk UPDATEs must call record_order itself.
+"""
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, event, func, inspect, insert, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from models import Crop, Order, OrderItem, OrderRollup, SalesRollup, db
+
+MEASURES = ('quantity', 'revenue', 'paid_revenue', 'order_count')
+
+def _counts(status, payment_status):
+    """Whether a line of an order in this state counts as sold, and as paid"""
+    counted = status != 'cancelled'
+    return counted, counted and payment_status == 'paid'
+
+def _order_day(order):
+    return (order.created_at or datetime.utcnow()).date()
+
+def _add_line(deltas, farmer_id, day, item, sign, paid):
+    totals = deltas[(farmer_id, day, item.crop_id)]
+    totals['quantity'] += sign * item.quantity
+    totals['revenue'] += sign * item.total_price
+    totals['order_count'] += sign
+    if paid:
+        totals['paid_revenue'] += sign * item.total_price
+
+def _new_deltas():
+    return defaultdict(lambda: dict.fromkeys(MEASURES, 0))
+
+def _farmers_of(session, crop_ids):
+    if not crop_ids:
+        return {}
+    with session.no_autoflush:
+        return dict(session.execute(select(Crop.id, Crop.farmer_id).where(Crop.id.in_(crop_ids))).all())
+
+def _upsert(session, model, keys, measures, rows):
+    """Add the measures of rows to the model's rows with the same keys, creating missing ones"""
+    if not rows:
+        return
+
+    dialect = session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        upsert = sqlite_insert if dialect == 'sqlite' else postgresql_insert
+        statement = upsert(model).values(rows)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={measure: getattr(model, measure) + getattr(statement.excluded, measure)
+                  for measure in measures}
+        ))
+        return
+
+    with session.no_autoflush:
+        for row in rows:
+            updated = session.execute(
+                model.__table__.update()
+                .where(*[getattr(model, key) == row[key] for key in keys])
+                .values({measure: getattr(model, measure) + row[measure] for measure in measures})
+            )
+            if updated.rowcount == 0:
+                session.execute(insert(model).values(row))
+
+def apply_deltas(session, deltas, order_deltas=None):
+    """Add {(farmer_id, day, crop_id): measures} and {(farmer_id, day): orders} to the rollups"""
+    _upsert(session, SalesRollup, ('farmer_id', 'day', 'crop_id'), MEASURES, [
+        {'farmer_id': farmer_id, 'day': day, 'crop_id': crop_id, **totals}
+        for (farmer_id, day, crop_id), totals in deltas.items()
+        if any(totals.values())
+    ])
+    _upsert(session, OrderRollup, ('farmer_id', 'day'), ('order_count',), [
+        {'farmer_id': farmer_id, 'day': day, 'order_count': count}
+        for (farmer_id, day), count in (order_deltas or {}).items()
+        if count
+    ])
+
+def record_order(order, sign):
+    """Add (sign=1) or take back (sign=-1) every line of a not cancelled order
+
+    For orders changed with bulk UPDATEs, which the listener cannot see.
+    """
+    paid = order.payment_status == 'paid'
+    farmers = _farmers_of(db.session, {item.crop_id for item in order.items})
+    deltas = _new_deltas()
+    for item in order.items:
+        _add_line(deltas, farmers[item.crop_id], _order_day(order), item, sign, paid)
+    order_deltas = {(farmer_id, _order_day(order)): sign for farmer_id in set(farmers.values())}
+    apply_deltas(db.session, deltas, order_deltas)
+
+def _old_value(order, key):
+    history = inspect(order).attrs[key].history
+    return history.deleted[0] if history.deleted else getattr(order, key)
+
+def _lines_before_and_after(session, order):
+    """The order's counted lines before this flush and after it"""
+    items = set(order.items)
+    items.update(obj for obj in session.new | session.deleted
+                 if isinstance(obj, OrderItem) and (obj.order is order or (order.id is not None and obj.order_id == order.id)))
+
+    before = []
+    if order not in session.new and _counts(_old_value(order, 'status'), _old_value(order, 'payment_status'))[0]:
+        before = [item for item in items if item not in session.new]
+    after = []
+    if order not in session.deleted and _counts(order.status, order.payment_status)[0]:
+        after = [item for item in items if item not in session.deleted]
+    return before, after
+
+@event.listens_for(Session, 'before_flush')
+def _roll_up_order_changes(session, flush_context, instances):
+    """Turn added, deleted and re-statused order lines into rollup deltas"""
+    changes = []  # (order, item, sign, paid)
+
+    with session.no_autoflush:
+        for obj in session.new:
+            if isinstance(obj, OrderItem):
+                order = obj.order or session.get(Order, obj.order_id)
+                counted, paid = _counts(order.status, order.payment_status)
+                if counted:
+                    changes.append((order, obj, 1, paid))
+
+        for obj in session.dirty:
+            if not isinstance(obj, Order) or obj in session.deleted:
+                continue
+            state = inspect(obj)
+            if not (state.attrs.status.history.has_changes() or
+                    state.attrs.payment_status.history.has_changes()):
+                continue
+            before = _counts(_old_value(obj, 'status'), _old_value(obj, 'payment_status'))
+            after = _counts(obj.status, obj.payment_status)
+            if before == after:
+                continue
+            for item in obj.items:
+                if item in session.new:
+                    continue
+                if before[0]:
+                    changes.append((obj, item, -1, before[1]))
+                if after[0]:
+                    changes.append((obj, item, 1, after[1]))
+
+        deleted_orders = set()
+        for obj in session.deleted:
+            if isinstance(obj, Order):
+                deleted_orders.add(obj)
+                counted, paid = _counts(_old_value(obj, 'status'), _old_value(obj, 'payment_status'))
+                if counted:
+                    changes.extend((obj, item, -1, paid) for item in obj.items)
+        for obj in session.deleted:
+            if isinstance(obj, OrderItem) and obj.order not in deleted_orders:
+                order = obj.order or session.get(Order, obj.order_id)
+                counted, paid = _counts(order.status, order.payment_status)
+                if counted:
+                    changes.append((order, obj, -1, paid))
+
+    if not changes:
+        return
+
+    with session.no_autoflush:
+        orders = {order for order, _, _, _ in changes}
+        lines = {order: _lines_before_and_after(session, order) for order in orders}
+    farmers = _farmers_of(session, {item.crop_id for _, item, _, _ in changes} |
+                          {item.crop_id for before, after in lines.values() for item in before + after})
+
+    deltas = _new_deltas()
+    for order, item, sign, paid in changes:
+        _add_line(deltas, farmers[item.crop_id], _order_day(order), item, sign, paid)
+
+    # An order counts once for every farmer with a counted line in it
+    order_deltas = defaultdict(int)
+    for order, (before, after) in lines.items():
+        farmers_before = {farmers[item.crop_id] for item in before}
+        farmers_after = {farmers[item.crop_id] for item in after}
+        for farmer_id in farmers_after - farmers_before:
+            order_deltas[(farmer_id, _order_day(order))] += 1
+        for farmer_id in farmers_before - farmers_after:
+            order_deltas[(farmer_id, _order_day(order))] -= 1
+    apply_deltas(session, deltas, order_deltas)
+
+def _as_date(day):
+    if isinstance(day, str):
+        return datetime.strptime(day, '%Y-%m-%d').date()
+    return day
+
+def init_sales_rollups():
+    """Fill the rollups from existing orders the first time they are used"""
+    if db.session.query(OrderItem.id).first() is None:
+        return
+    day = func.date(Order.created_at)
+
+    if db.session.query(OrderRollup.id).first() is None:
+        rows = (db.session.query(Crop.farmer_id, day, func.count(func.distinct(Order.id)))
+                .select_from(OrderItem)
+                .join(Order, Order.id == OrderItem.order_id)
+                .join(Crop, Crop.id == OrderItem.crop_id)
+                .filter(Order.status != 'cancelled')
+                .group_by(Crop.farmer_id, day)
+                .all())
+        apply_deltas(db.session, {}, {(farmer_id, _as_date(order_day)): count for farmer_id, order_day, count in rows})
+        db.session.commit()
+
+    if db.session.query(SalesRollup.id).first() is not None:
+        return
+
+    rows = (db.session.query(
+                Crop.farmer_id, day, OrderItem.crop_id,
+                func.sum(OrderItem.quantity), func.sum(OrderItem.total_price),
+                func.sum(case((Order.payment_status == 'paid', OrderItem.total_price), else_=0)),
+                func.count(OrderItem.id))
+            .join(Order, Order.id == OrderItem.order_id)
+            .join(Crop, Crop.id == OrderItem.crop_id)
+            .filter(Order.status != 'cancelled')
+            .group_by(Crop.farmer_id, day, OrderItem.crop_id)
+            .all())
+
+    deltas = _new_deltas()
+    for farmer_id, order_day, crop_id, quantity, revenue, paid_revenue, order_count in rows:
+        deltas[(farmer_id, _as_date(order_day), crop_id)].update(
+            quantity=quantity, revenue=revenue, paid_revenue=paid_revenue, order_count=order_count)
+    apply_deltas(db.session, deltas)
+    db.session.commit()
+
+def weekly_sales(farmer_id, weeks=12, crop_id=None):
+    """The farmer's sales per ISO week and crop over the last weeks
+
+    Returns (rows, totals): rows are dicts with week (its Monday), crop and
+    the summed measures, newest week first; totals sums every row, except
+    that across crops order_count counts each order once.
+    """
+    today = datetime.utcnow().date()
+    start = today - timedelta(days=today.weekday()) - timedelta(weeks=weeks - 1)
+
+    query = (db.session.query(SalesRollup, Crop)
+             .join(Crop, Crop.id == SalesRollup.crop_id)
+             .filter(SalesRollup.farmer_id == farmer_id, SalesRollup.day >= start))
+    if crop_id:
+        query = query.filter(SalesRollup.crop_id == crop_id)
+
+    buckets = {}
+    totals = dict.fromkeys(MEASURES, 0)
+    for rollup, crop in query:
+        week = rollup.day - timedelta(days=rollup.day.weekday())
+        row = buckets.setdefault((week, crop.id), dict(dict.fromkeys(MEASURES, 0), week=week, crop=crop))
+        for measure in MEASURES:
+            row[measure] += getattr(rollup, measure)
+            totals[measure] += getattr(rollup, measure)
+
+    if not crop_id:
+        totals['order_count'] = (db.session.query(func.coalesce(func.sum(OrderRollup.order_count), 0))
+                                 .filter(OrderRollup.farmer_id == farmer_id, OrderRollup.day >= start)
+                                 .scalar())
+
+    rows = sorted(buckets.values(), key=lambda row: (-row['week'].toordinal(), row['crop'].name))
+    return rows, totals
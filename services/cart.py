@@ -0,0 +1,162 @@
+"""
+Server-side shopping carts.
+
+Carts live in the carts/cart_items tables keyed by the buyer, so the
+session cookie carries no cart data, carts follow the buyer across devices
+and there is no size limit. Quantities are written with bulk INSERT ... ON
+CONFLICT upserts and a single DELETE, whatever the number of lines.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+
+from models import Cart, CartItem, Crop, db
+
+def get_cart(user, create=False):
+    """The buyer's cart, created on demand when create is set"""
+    cart = Cart.query.filter_by(user_id=user.id).first()
+    if cart is None and create:
+        try:
+            with db.session.begin_nested():
+                cart = Cart(user_id=user.id)
+                db.session.add(cart)
+        except IntegrityError:
+            # Another request created it first
+            cart = Cart.query.filter_by(user_id=user.id).first()
+    return cart
+
+def load_cart(user):
+    """Resolve the buyer's cart into line items and a total
+
+    Lines, crops and farmers are fetched with a single query, so the cost
+    does not grow with the number of lines. Lines for crops that are no
+    longer active are left out.
+    """
+    rows = (db.session.query(CartItem.quantity, Crop)
+            .join(Cart, Cart.id == CartItem.cart_id)
+            .join(Crop, Crop.id == CartItem.crop_id)
+            .options(joinedload(Crop.farmer))
+            .filter(Cart.user_id == user.id, Crop.is_active == True, CartItem.quantity > 0)
+            .order_by(CartItem.id)
+            .all())
+
+    cart_items = []
+    total_amount = 0
+    for quantity, crop in rows:
+        item_total = crop.price_per_unit * quantity
+        cart_items.append({
+            'crop': crop,
+            'quantity': quantity,
+            'total': item_total
+        })
+        total_amount += item_total
+
+    return cart_items, total_amount
+
+def cart_totals(user):
+    """Number of lines and total amount of the buyer's cart, in one query"""
+    count, total = (db.session.query(func.count(CartItem.id), func.sum(CartItem.quantity * Crop.price_per_unit))
+                    .join(Cart, Cart.id == CartItem.cart_id)
+                    .join(Crop, Crop.id == CartItem.crop_id)
+                    .filter(Cart.user_id == user.id, Crop.is_active == True, CartItem.quantity > 0)
+                    .one())
+    return count, total or 0
+
+def cart_lines(user, crop_ids):
+    """Quantities of the given crops in the buyer's cart, as {crop_id: quantity}"""
+    if not crop_ids:
+        return {}
+    return dict(db.session.query(CartItem.crop_id, CartItem.quantity)
+                .join(Cart, Cart.id == CartItem.cart_id)
+                .filter(Cart.user_id == user.id, CartItem.crop_id.in_(crop_ids))
+                .all())
+
+def _upsert(cart, quantities, increment):
+    """Insert or update cart lines from {crop_id: quantity} in one statement"""
+    if not quantities:
+        return
+
+    now = datetime.utcnow()
+    dialect = db.engine.dialect.name
+
+    if dialect in ('sqlite', 'postgresql'):
+        insert = sqlite_insert if dialect == 'sqlite' else postgresql_insert
+        statement = insert(CartItem).values([
+            {'cart_id': cart.id, 'crop_id': crop_id, 'quantity': quantity,
+             'created_at': now, 'updated_at': now}
+            for crop_id, quantity in quantities.items()
+        ])
+        new_quantity = statement.excluded.quantity
+        if increment:
+            new_quantity = CartItem.quantity + statement.excluded.quantity
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['cart_id', 'crop_id'],
+            set_={'quantity': new_quantity, 'updated_at': now}
+        ))
+    else:
+        existing = {item.crop_id: item for item in CartItem.query.filter(
+            CartItem.cart_id == cart.id, CartItem.crop_id.in_(quantities.keys()))}
+        for crop_id, quantity in quantities.items():
+            item = existing.get(crop_id)
+            if item is None:
+                db.session.add(CartItem(cart_id=cart.id, crop_id=crop_id, quantity=quantity))
+            elif increment:
+                item.quantity += quantity
+            else:
+                item.quantity = quantity
+
+    cart.updated_at = now
+
+def add_items(user, quantities):
+    """Add {crop_id: quantity} to the buyer's cart, on top of what is there"""
+    cart = get_cart(user, create=True)
+    _upsert(cart, quantities, increment=True)
+    db.session.commit()
+
+def set_items(user, quantities):
+    """Set cart quantities from {crop_id: quantity}; zero or less removes the line"""
+    cart = get_cart(user, create=True)
+
+    removed = [crop_id for crop_id, quantity in quantities.items() if quantity <= 0]
+    if removed:
+        CartItem.query.filter(
+            CartItem.cart_id == cart.id,
+            CartItem.crop_id.in_(removed)
+        ).delete(synchronize_session=False)
+
+    _upsert(cart, {crop_id: quantity for crop_id, quantity in quantities.items() if quantity > 0},
+            increment=False)
+    db.session.commit()
+
+def clear_cart(user):
+    """Remove every line from the buyer's cart"""
+    cart = get_cart(user)
+    if cart is not None:
+        CartItem.query.filter_by(cart_id=cart.id).delete(synchronize_session=False)
+        db.session.commit()
+
+def merge_session_cart(user, session):
+    """Move a cookie-session cart into the buyer's server-side cart on login
+
+    Carts used to live in the signed session cookie as {crop_id: quantity};
+    any such cart still present is merged so nothing is lost on upgrade.
+    """
+    legacy = session.pop('cart', None)
+    if not legacy:
+        return
+
+    quantities = {}
+    for crop_id, quantity in legacy.items():
+        try:
+            quantities[int(crop_id)] = float(quantity)
+        except (TypeError, ValueError):
+            continue
+
+    existing = {crop.id for crop in Crop.query.filter(Crop.id.in_(quantities.keys()))}
+    add_items(user, {crop_id: quantity for crop_id, quantity in quantities.items()
+                     if crop_id in existing and quantity > 0})
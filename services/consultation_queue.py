@@ -0,0 +1,90 @@
+"""
+The queue of unclaimed consultation requests.
+
+Pending consultations without a consultant are served most urgent first,
+then oldest first. The order uses the stored Consultation.priority_rank, so
+the queue is read straight from ix_consultations_queue. A consultation is
+claimed with one conditional UPDATE that only matches while it is still
+unclaimed, so when two consultants go for the same request exactly one of
+them gets it. On PostgreSQL "claim next N" locks its candidates with FOR
+UPDATE SKIP LOCKED, so concurrent claimers take different rows instead of
+queueing behind each other.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import select, update
+
+from models import Consultation, db
+from services.consultations import invalidate
+from services.sla import record_claims
+
+# Most consultations claimed by one "claim next" request
+MAX_CLAIM_BATCH = 10
+
+# Re-reads of the queue when other consultants win every candidate
+CLAIM_ATTEMPTS = 3
+
+# Keyset pagination keys of the queue order
+QUEUE_KEYS = [(Consultation.priority_rank, False), (Consultation.created_at, False), (Consultation.id, False)]
+
+def _unclaimed():
+    return (Consultation.consultant_id.is_(None), Consultation.status == 'pending')
+
+def unclaimed_query():
+    """Unclaimed pending consultations, without an order"""
+    return Consultation.query.filter(*_unclaimed())
+
+def _claim(consultant_id, where):
+    now = datetime.utcnow()
+    return (update(Consultation)
+            .where(*_unclaimed(), where)
+            .values(consultant_id=consultant_id, status='in_progress', claimed_at=now, updated_at=now)
+            .execution_options(synchronize_session=False))
+
+def take(consultant_id, consultation_id):
+    """Give an unclaimed consultation to a consultant; False if it is already taken. Does not commit."""
+    if db.session.execute(_claim(consultant_id, Consultation.id == consultation_id)).rowcount != 1:
+        return False
+    record_claims([consultation_id])
+    return True
+
+def claim(consultant_id, consultation_id):
+    """Claim one consultation; False if it is gone or someone else claimed it first"""
+    claimed = take(consultant_id, consultation_id)
+    db.session.commit()
+    if claimed:
+        invalidate([consultant_id])
+    return claimed
+
+def _next_ids(count):
+    return (select(Consultation.id)
+            .where(*_unclaimed())
+            .order_by(*[column for column, _ in QUEUE_KEYS])
+            .limit(count))
+
+def claim_next(consultant_id, count=1):
+    """Claim up to count consultations from the head of the queue and return their ids"""
+    count = max(1, min(count, MAX_CLAIM_BATCH))
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        candidates = _next_ids(count).with_for_update(skip_locked=True).scalar_subquery()
+        claimed = list(db.session.execute(
+            _claim(consultant_id, Consultation.id.in_(candidates)).returning(Consultation.id)
+        ).scalars())
+        record_claims(claimed)
+    else:
+        claimed = []
+        for _ in range(CLAIM_ATTEMPTS):
+            wanted = count - len(claimed)
+            candidates = db.session.execute(_next_ids(wanted)).scalars().all()
+            for consultation_id in candidates:
+                if take(consultant_id, consultation_id):
+                    claimed.append(consultation_id)
+            if len(claimed) == count or len(candidates) < wanted:
+                break
+
+    db.session.commit()
+    if claimed:
+        invalidate([consultant_id])
+    return claimed
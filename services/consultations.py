@@ -0,0 +1,85 @@
+"""
+Per-consultant consultation statistics.
+
+A consultant's totals per category come from one GROUP BY query and are
+cached in process. Committed changes to a consultation's status, rating,
+category or consultant drop the cached entries they affect (see
+services.indexing.apply_on_commit), and entries expire after CACHE_SECONDS
+so changes made by other processes show up too. Code that changes
+consultations with bulk UPDATEs must call invalidate itself.
+"""
+
+import threading
+import time
+
+from sqlalchemy import case, func, inspect
+
+from models import Consultation, db
+from services.indexing import apply_on_commit
+
+# Seconds a consultant's statistics are served from memory
+CACHE_SECONDS = 300
+
+# Columns whose changes alter the statistics
+TRACKED_FIELDS = ('status', 'rating', 'category', 'consultant_id')
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+def _query_category_stats(consultant_id):
+    rows = (db.session.query(Consultation.category,
+                             func.count(Consultation.id),
+                             func.sum(case((Consultation.status == 'completed', 1), else_=0)),
+                             func.avg(Consultation.rating))
+            .filter(Consultation.consultant_id == consultant_id)
+            .group_by(Consultation.category)
+            .order_by(Consultation.category)
+            .all())
+    return {
+        category: {'total': total, 'completed': completed or 0, 'avg_rating': float(avg_rating or 0)}
+        for category, total, completed, avg_rating in rows
+    }
+
+def category_stats(consultant_id):
+    """{category: {total, completed, avg_rating}} of a consultant's consultations"""
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _cache.get(consultant_id)
+        if cached is not None and now - cached[0] < CACHE_SECONDS:
+            return cached[1]
+
+    stats = _query_category_stats(consultant_id)
+    with _cache_lock:
+        _cache[consultant_id] = (now, stats)
+    return stats
+
+def invalidate(consultant_ids):
+    """Drop the cached statistics of these consultants"""
+    with _cache_lock:
+        for consultant_id in consultant_ids:
+            _cache.pop(consultant_id, None)
+
+def _old_value(obj, key):
+    history = inspect(obj).attrs[key].history
+    return history.deleted[0] if history.deleted else getattr(obj, key)
+
+def _changed_consultants(session):
+    """Consultants whose statistics a flush changed"""
+    changed = set()
+    for obj in session.new:
+        if isinstance(obj, Consultation):
+            changed.add(obj.consultant_id)
+    for obj in session.deleted:
+        if isinstance(obj, Consultation):
+            changed.add(_old_value(obj, 'consultant_id'))
+    for obj in session.dirty:
+        if not isinstance(obj, Consultation):
+            continue
+        state = inspect(obj)
+        if any(state.attrs[key].history.has_changes() for key in TRACKED_FIELDS):
+            changed.update((_old_value(obj, 'consultant_id'), obj.consultant_id))
+
+    changed.discard(None)
+    return list(changed)
+
+apply_on_commit(_changed_consultants, invalidate)
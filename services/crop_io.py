@@ -0,0 +1,244 @@
+"""
+Bulk import and export of crop listings.
+
+Files are read and written as streams: uploads are parsed one record at a
+time (CSV, a JSON array or newline-delimited JSON), inserted in batches of
+IMPORT_BATCH rows per transaction, and exports are generated row by row from
+a server-side cursor. Memory use stays flat whatever the number of rows.
+"""
+
+import codecs
+import csv
+import io
+import json
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import Crop, db
+
+# Columns of the import/export format; id and is_active are export-only
+CROP_FIELDS = ('name', 'variety', 'description', 'price_per_unit', 'unit', 'quantity_available',
+               'harvest_date', 'location', 'is_organic')
+EXPORT_FIELDS = ('id',) + CROP_FIELDS + ('is_active',)
+
+UNITS = ('kg', 'quintal', 'ton', 'piece', 'dozen', 'box')
+
+# Rows inserted per transaction
+IMPORT_BATCH = 1000
+
+# Rows read from the database per round trip while exporting
+EXPORT_BATCH = 1000
+
+# Errors kept for the report; later ones are only counted
+MAX_REPORTED_ERRORS = 100
+
+# Bytes of a JSON upload decoded at a time
+READ_CHUNK = 64 * 1024
+
+# Largest single JSON record accepted, in characters
+MAX_RECORD_SIZE = 64 * 1024
+
+ImportResult = namedtuple('ImportResult', 'imported failed errors')
+
+def _text(record, key, limit, required=False):
+    value = record.get(key)
+    value = '' if value is None else str(value).strip()
+    if required and not value:
+        raise ValueError(f'{key} is required')
+    if len(value) > limit:
+        raise ValueError(f'{key} is longer than {limit} characters')
+    return value
+
+def _number(record, key):
+    value = record.get(key)
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{key} must be a number')
+    if number != number or number < 0 or number == float('inf'):
+        raise ValueError(f'{key} must be zero or more')
+    return number
+
+def parse_crop(record):
+    """Validate one imported record into Crop column values; raises ValueError"""
+    if not isinstance(record, dict):
+        raise ValueError('record must be an object')
+
+    unit = _text(record, 'unit', 20) or 'kg'
+    if unit not in UNITS:
+        raise ValueError(f"unit must be one of {', '.join(UNITS)}")
+
+    harvest_date = None
+    harvest_date_str = _text(record, 'harvest_date', 10)
+    if harvest_date_str:
+        try:
+            harvest_date = datetime.strptime(harvest_date_str, '%Y-%m-%d').date()
+        except ValueError:
+            raise ValueError('harvest_date must be YYYY-MM-DD')
+
+    is_organic = record.get('is_organic')
+    if not isinstance(is_organic, bool):
+        is_organic = str(is_organic or '').strip().lower() in ('1', 'true', 'yes', 'on', 'y')
+
+    return {
+        'name': _text(record, 'name', 100, required=True),
+        'variety': _text(record, 'variety', 100),
+        'description': _text(record, 'description', 10000),
+        'price_per_unit': _number(record, 'price_per_unit'),
+        'unit': unit,
+        'quantity_available': _number(record, 'quantity_available'),
+        'harvest_date': harvest_date,
+        'location': _text(record, 'location', 200, required=True),
+        'is_organic': is_organic
+    }
+
+def _csv_records(lines):
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, row
+
+def _json_records(chunks):
+    """Yield the objects of a JSON array or of newline-delimited JSON, one at a time"""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    in_array = None
+    number = 0
+
+    for chunk in chunks:
+        buffer += chunk
+        position = 0
+        while True:
+            skip = ', \t\r\n' if in_array else ' \t\r\n'
+            while position < len(buffer) and buffer[position] in skip:
+                position += 1
+            if position == len(buffer):
+                break
+            if in_array is None:
+                in_array = buffer[position] == '['
+                if in_array:
+                    position += 1
+                continue
+            if in_array and buffer[position] == ']':
+                return
+            try:
+                record, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if len(buffer) - position > MAX_RECORD_SIZE:
+                    raise ValueError(f'Malformed JSON after record {number}')
+                # The record continues in the next chunk
+                break
+            number += 1
+            yield number, record
+        buffer = buffer[position:]
+
+    if buffer.strip() or in_array:
+        raise ValueError(f'Malformed JSON after record {number}')
+
+def _chunks(stream):
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    while True:
+        data = stream.read(READ_CHUNK)
+        yield decoder.decode(data, final=not data)
+        if not data:
+            return
+
+def read_records(stream, fmt):
+    """Yield (row number, record) from an uploaded binary stream in 'csv' or 'json'"""
+    if fmt == 'csv':
+        return _csv_records(codecs.iterdecode(stream, 'utf-8-sig'))
+    return _json_records(_chunks(stream))
+
+def _insert_batch(farmer_id, batch, errors, failed):
+    """Insert one batch in its own transaction; returns the number of rows inserted"""
+    try:
+        db.session.add_all(Crop(farmer_id=farmer_id, **values) for _, values in batch)
+        db.session.commit()
+        return len(batch)
+    except SQLAlchemyError:
+        db.session.rollback()
+
+    # Find the offending rows by inserting the batch one row at a time
+    imported = 0
+    for number, values in batch:
+        try:
+            db.session.add(Crop(farmer_id=farmer_id, **values))
+            db.session.commit()
+            imported += 1
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            failed[0] += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append((number, str(getattr(e, 'orig', e))))
+    return imported
+
+def import_crops(farmer_id, records, batch_size=IMPORT_BATCH):
+    """Validate and insert (row number, record) pairs as the farmer's crops
+
+    Valid rows are committed batch by batch, so a bad row never discards
+    the good ones around it. Returns an ImportResult with the number of rows
+    imported and failed and the first MAX_REPORTED_ERRORS (row, message).
+    """
+    imported = 0
+    failed = [0]
+    errors = []
+    batch = []
+
+    try:
+        for number, record in records:
+            try:
+                batch.append((number, parse_crop(record)))
+            except ValueError as e:
+                failed[0] += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append((number, str(e)))
+                continue
+
+            if len(batch) == batch_size:
+                imported += _insert_batch(farmer_id, batch, errors, failed)
+                batch = []
+    except (ValueError, csv.Error, UnicodeDecodeError) as e:
+        # The file itself is unreadable from here on
+        failed[0] += 1
+        errors.append((None, str(e)))
+
+    if batch:
+        imported += _insert_batch(farmer_id, batch, errors, failed)
+
+    return ImportResult(imported, failed[0], errors)
+
+def _export_value(crop, field):
+    value = getattr(crop, field)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+def _farmer_crops(farmer_id):
+    return (Crop.query
+            .filter_by(farmer_id=farmer_id)
+            .order_by(Crop.id)
+            .yield_per(EXPORT_BATCH))
+
+def export_csv(farmer_id):
+    """Generate the farmer's crops as CSV text, one row at a time"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(EXPORT_FIELDS)
+    for crop in _farmer_crops(farmer_id):
+        writer.writerow([_export_value(crop, field) for field in EXPORT_FIELDS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def export_json(farmer_id):
+    """Generate the farmer's crops as a JSON array, one record at a time"""
+    separator = '[\n'
+    for crop in _farmer_crops(farmer_id):
+        yield separator + json.dumps({field: _export_value(crop, field) for field in EXPORT_FIELDS})
+        separator = ',\n'
+    yield '[]\n' if separator == '[\n' else '\n]\n'
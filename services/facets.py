@@ -0,0 +1,214 @@
+"""
+Facet counts for the crop catalog.
+
+Every active crop gets a dense bit position, and every facet value keeps a
+bitmap (a Python int) of the positions of the crops carrying that value.
+Counts for the current selection are then one AND + popcount per facet
+value instead of a COUNT query per facet. The bitmaps are kept current as
+crops are added, edited or deactivated (see services.indexing); positions
+of removed crops are reused, so bitmaps stay as wide as the catalog.
+"""
+
+from collections import defaultdict
+
+from sqlalchemy import func, or_
+
+from models import Crop
+from services.indexing import CropIndex
+
+# Lower bounds of the price buckets, in taka per unit
+PRICE_BUCKETS = [0, 25, 50, 100, 250, 500]
+
+# Values shown per facet, most common first
+MAX_FACET_VALUES = 10
+
+FACETS = ('organic', 'district', 'unit', 'crop', 'price')
+
+if hasattr(int, 'bit_count'):
+    _popcount = int.bit_count
+else:
+    def _popcount(bits):
+        return bin(bits).count('1')
+
+def _bitmap(positions, width):
+    """Bitmap with the given bit positions set"""
+    bits = bytearray(width // 8 + 1)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, 'little')
+
+def district_of(location):
+    """First component of a free-text location, e.g. 'Rajshahi' for 'Rajshahi, Bangladesh'"""
+    return (location or '').split(',')[0].strip().title()
+
+def price_bucket(price):
+    """Index of the PRICE_BUCKETS range a price falls into"""
+    bucket = 0
+    for i, lower in enumerate(PRICE_BUCKETS):
+        if price >= lower:
+            bucket = i
+    return bucket
+
+def price_label(bucket):
+    lower = PRICE_BUCKETS[bucket]
+    if bucket + 1 < len(PRICE_BUCKETS):
+        return f'৳{lower}–{PRICE_BUCKETS[bucket + 1]}'
+    return f'৳{lower}+'
+
+def facet_values(name, location, unit, is_organic, price_per_unit):
+    """Facet values of a single crop"""
+    return {
+        'organic': bool(is_organic),
+        'district': district_of(location),
+        'unit': unit,
+        'crop': (name or '').strip().title(),
+        'price': price_bucket(price_per_unit or 0),
+    }
+
+def facet_param(facet, value):
+    """Request argument value selecting a facet value"""
+    if facet == 'organic':
+        return 'yes' if value else 'no'
+    return str(value)
+
+def facet_label(facet, value):
+    if facet == 'organic':
+        return 'Organic' if value else 'Conventional'
+    if facet == 'price':
+        return price_label(value)
+    return value
+
+class FacetIndex(CropIndex):
+    """Bitmap index of active crops by facet value"""
+
+    columns = (Crop.name, Crop.location, Crop.unit, Crop.is_organic, Crop.price_per_unit)
+
+    def values_of(self, name, location, unit, is_organic, price_per_unit):
+        return facet_values(name, location, unit, is_organic, price_per_unit)
+
+    def _reset(self):
+        self._bitmaps = {facet: {} for facet in FACETS}
+        self._values = {}
+        self._positions = {}  # crop id -> bit position
+        self._free = []  # positions of removed crops, reused first
+
+    def _add(self, crop_id, values):
+        position = self._free.pop() if self._free else len(self._positions)
+        self._positions[crop_id] = position
+        self._values[crop_id] = values
+        bit = 1 << position
+        for facet, value in values.items():
+            bitmaps = self._bitmaps[facet]
+            bitmaps[value] = bitmaps.get(value, 0) | bit
+
+    def _remove(self, crop_id):
+        values = self._values.pop(crop_id, None)
+        if values is None:
+            return
+        position = self._positions.pop(crop_id)
+        self._free.append(position)
+        mask = ~(1 << position)
+        for facet, value in values.items():
+            bitmaps = self._bitmaps[facet]
+            bitmaps[value] &= mask
+            if not bitmaps[value]:
+                del bitmaps[value]
+
+    def _load(self, entries):
+        # Collect positions per value and build each bitmap once; OR-ing
+        # crops in one at a time copies the growing bitmap every time
+        members = {facet: defaultdict(list) for facet in FACETS}
+        for position, (crop_id, values) in enumerate(entries):
+            self._positions[crop_id] = position
+            self._values[crop_id] = values
+            for facet, value in values.items():
+                members[facet][value].append(position)
+        for facet, by_value in members.items():
+            for value, positions in by_value.items():
+                self._bitmaps[facet][value] = _bitmap(positions, len(self._positions))
+
+    def counts(self, selected, crop_ids=None):
+        """Count active crops per facet value under the selected filters
+
+        Each facet is counted with the selections of the *other* facets
+        applied, so picking one unit still shows how many crops every other
+        unit has. crop_ids, when given, limits the counts to those crops,
+        e.g. the ones matching a search.
+        """
+        self.ensure_fresh()
+
+        with self._lock:
+            everything = 0
+            for bitmap in self._bitmaps['organic'].values():
+                everything |= bitmap
+            if crop_ids is not None:
+                width = len(self._positions) + len(self._free)
+                everything &= _bitmap([self._positions[crop_id] for crop_id in crop_ids
+                                       if crop_id in self._positions], width)
+
+            selected_bits = {
+                facet: self._bitmaps[facet].get(value, 0)
+                for facet, value in selected.items()
+            }
+
+            result = {}
+            for facet in FACETS:
+                mask = everything
+                for other, bits in selected_bits.items():
+                    if other != facet:
+                        mask &= bits
+
+                values = []
+                for value, bitmap in self._bitmaps[facet].items():
+                    count = _popcount(bitmap & mask)
+                    if count:
+                        values.append({
+                            'value': value,
+                            'param': facet_param(facet, value),
+                            'label': facet_label(facet, value),
+                            'count': count,
+                            'selected': facet in selected and selected[facet] == value,
+                        })
+
+                values.sort(key=lambda v: (-v['count'], str(v['label'])))
+                result[facet] = values[:MAX_FACET_VALUES]
+
+        return result
+
+crop_facets = FacetIndex()
+
+def parse_facet_selection(args):
+    """Read facet selections from request arguments"""
+    selected = {}
+    if args.get('organic_only') == 'on' or args.get('organic') == 'yes':
+        selected['organic'] = True
+    elif args.get('organic') == 'no':
+        selected['organic'] = False
+    for facet in ('district', 'unit', 'crop'):
+        if args.get(facet):
+            selected[facet] = args.get(facet)
+    price = args.get('price', type=int)
+    if price is not None and 0 <= price < len(PRICE_BUCKETS):
+        selected['price'] = price
+    return selected
+
+def filter_by_facets(query, selected):
+    """Restrict a Crop query to the selected facet values"""
+    if 'organic' in selected:
+        query = query.filter(Crop.is_organic == selected['organic'])
+    if 'district' in selected:
+        district = selected['district']
+        query = query.filter(or_(
+            func.lower(func.trim(Crop.location)) == district.lower(),
+            Crop.location.ilike(f'{district},%'),
+        ))
+    if 'unit' in selected:
+        query = query.filter(Crop.unit == selected['unit'])
+    if 'crop' in selected:
+        query = query.filter(func.lower(func.trim(Crop.name)) == selected['crop'].lower())
+    if 'price' in selected:
+        bucket = selected['price']
+        query = query.filter(Crop.price_per_unit >= PRICE_BUCKETS[bucket])
+        if bucket + 1 < len(PRICE_BUCKETS):
+            query = query.filter(Crop.price_per_unit < PRICE_BUCKETS[bucket + 1])
+    return query
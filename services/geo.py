@@ -0,0 +1,272 @@
+"""
+Offline geocoding and "crops near me" search.
+
+Locations and addresses are free text, so they are geocoded against a
+bundled gazetteer of Bangladeshi districts and major upazilas
+(data/bd_gazetteer.csv) whenever a crop or user is saved, and rows saved
+before geocoding existed are filled in on startup. Active crops with
+coordinates are kept in a uniform grid index. A radius query visits grid
+cells nearest first and stops as soon as a page is filled, so it only looks
+at the listings around the search point instead of every one in range.
+"""
+
+import csv
+import heapq
+import math
+import os
+import re
+from collections import namedtuple
+from functools import lru_cache
+from itertools import islice
+
+from sqlalchemy import bindparam, event, inspect
+from sqlalchemy.orm import Session
+
+from models import Crop, User, db
+from services.indexing import CropIndex
+from services.pagination import encode_cursor, decode_values
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'bd_gazetteer.csv')
+
+# Grid cell size in degrees (about 11 km of latitude)
+CELL_DEGREES = 0.1
+
+EARTH_RADIUS_KM = 6371.0
+
+# Most crops fetched from the database per round while filling a page;
+# rounds start at one page and double while the query filters crops out
+FETCH_BATCH = 1000
+
+# Slack on cell distance bounds, covering the flat-box approximation and
+# the rounding of distances to metres
+BOUND_SLACK = 0.01
+
+Place = namedtuple('Place', 'name kind division latitude longitude')
+
+def _normalize(text):
+    return re.sub(r"[^a-z0-9]+", ' ', (text or '').lower().replace("'", '')).strip()
+
+@lru_cache(maxsize=1)
+def load_gazetteer():
+    """Map normalized place names and aliases to Place records"""
+    places = {}
+    with open(GAZETTEER_PATH, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            place = Place(row['name'], row['kind'], row['division'],
+                          float(row['latitude']), float(row['longitude']))
+            for name in [row['name']] + [a for a in (row['aliases'] or '').split(';') if a]:
+                places[_normalize(name)] = place
+    return places
+
+def place_names():
+    """Sorted names of all gazetteer places, for autocompletion"""
+    return sorted({place.name for place in load_gazetteer().values()})
+
+def geocode(text):
+    """Coordinates of the most specific gazetteer place named in text, or None"""
+    places = load_gazetteer()
+    words = _normalize(text).split()
+
+    found = []
+    i = 0
+    while i < len(words):
+        # Prefer two-word names such as "Cox Bazar" over their first word
+        pair = ' '.join(words[i:i + 2])
+        if i + 1 < len(words) and pair in places:
+            found.append(places[pair])
+            i += 2
+        elif words[i] in places:
+            found.append(places[words[i]])
+            i += 1
+        else:
+            i += 1
+
+    if not found:
+        return None
+
+    upazilas = [place for place in found if place.kind == 'upazila']
+    place = upazilas[0] if upazilas else found[0]
+    return place.latitude, place.longitude
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in kilometres"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def _cell(latitude, longitude):
+    return int(math.floor(latitude / CELL_DEGREES)), int(math.floor(longitude / CELL_DEGREES))
+
+class GridIndex(CropIndex):
+    """Uniform grid of active crop coordinates"""
+
+    columns = (Crop.latitude, Crop.longitude)
+
+    def values_of(self, latitude, longitude):
+        if latitude is None or longitude is None:
+            return None
+        return latitude, longitude
+
+    def _reset(self):
+        self._cells = {}
+        self._points = {}
+
+    def _add(self, crop_id, point):
+        self._points[crop_id] = point
+        self._cells.setdefault(_cell(*point), set()).add(crop_id)
+
+    def _remove(self, crop_id):
+        point = self._points.pop(crop_id, None)
+        if point is None:
+            return
+        cell = _cell(*point)
+        self._cells[cell].discard(crop_id)
+        if not self._cells[cell]:
+            del self._cells[cell]
+
+    def _cell_bounds(self, latitude, longitude, cell):
+        """Lower and upper bounds on the distance from a point to anything in a cell"""
+        i, j = cell
+        south, west = i * CELL_DEGREES, j * CELL_DEGREES
+        north, east = south + CELL_DEGREES, west + CELL_DEGREES
+        nearest = haversine_km(latitude, longitude,
+                               min(max(latitude, south), north), min(max(longitude, west), east))
+        farthest = max(haversine_km(latitude, longitude, corner_lat, corner_lon)
+                       for corner_lat in (south, north) for corner_lon in (west, east))
+        return max(nearest * (1 - BOUND_SLACK) - 0.001, 0), farthest * (1 + BOUND_SLACK) + 0.001
+
+    def nearest(self, latitude, longitude, radius_km, after=None):
+        """Yield (distance_km, crop_id) of crops within radius_km, nearest first
+
+        Cells are opened in order of their distance bound, so a consumer that
+        stops early never looks at the crops further out. With after, only
+        entries greater than that (distance_km, crop_id) are yielded and
+        cells lying wholly before it are skipped.
+        """
+        self.ensure_fresh()
+
+        # Bounding box of the search circle, in grid cells
+        dlat = radius_km / 111.0
+        dlon = radius_km / (111.32 * max(math.cos(math.radians(latitude)), 0.01))
+        min_i, min_j = _cell(latitude - dlat, longitude - dlon)
+        max_i, max_j = _cell(latitude + dlat, longitude + dlon)
+
+        # Entries are (distance, 0, cell) or (distance, 1, crop_id): a cell is
+        # opened before any crop at its bound is handed out
+        heap = []
+        with self._lock:
+            occupied = [(i, j) for i in range(min_i, max_i + 1) for j in range(min_j, max_j + 1)
+                        if (i, j) in self._cells]
+        for cell in occupied:
+            lower, upper = self._cell_bounds(latitude, longitude, cell)
+            if lower <= radius_km and (after is None or upper >= after[0]):
+                heap.append((lower, 0, cell))
+        heapq.heapify(heap)
+
+        while heap:
+            distance, kind, item = heapq.heappop(heap)
+            if distance > radius_km:
+                return
+            if kind == 1:
+                yield distance, item
+                continue
+            with self._lock:
+                points = [(crop_id, self._points[crop_id]) for crop_id in self._cells.get(item, ())]
+            for crop_id, point in points:
+                entry = (round(haversine_km(latitude, longitude, *point), 3), crop_id)
+                if entry[0] <= radius_km and (after is None or entry > after):
+                    heapq.heappush(heap, (entry[0], 1, crop_id))
+
+crop_locations = GridIndex()
+
+def crop_ids_within(latitude, longitude, radius_km):
+    """Ids of the active crops within radius_km"""
+    return {crop_id for _, crop_id in crop_locations.nearest(latitude, longitude, radius_km)}
+
+def nearest_crops(query, latitude, longitude, radius_km, cursor=None, per_page=20):
+    """Page through the crops of query within radius_km, nearest first
+
+    Returns the crops, their distances by crop id and the next page cursor.
+    """
+    after = decode_values(cursor, 2) if cursor else None
+    if after is not None and all(isinstance(value, (int, float)) for value in after):
+        after = tuple(after)
+    else:
+        after = None
+    ranked = crop_locations.nearest(latitude, longitude, radius_km, after)
+
+    # One crop past the page tells whether there is a next one
+    crops = []
+    distances = {}
+    batch_size = per_page + 1
+    while len(crops) <= per_page:
+        chunk = list(islice(ranked, batch_size))
+        if not chunk:
+            break
+        found = {crop.id: crop for crop in query.filter(Crop.id.in_([crop_id for _, crop_id in chunk])).all()}
+        for distance, crop_id in chunk:
+            if crop_id in found and len(crops) <= per_page:
+                crops.append(found[crop_id])
+                distances[crop_id] = distance
+        batch_size = min(batch_size * 2, FETCH_BATCH)
+
+    if len(crops) <= per_page:
+        return crops, distances, None
+    del distances[crops.pop().id]
+    last = crops[-1].id
+    return crops, distances, encode_cursor([distances[last], last])
+
+def _farmer_point(session, crop):
+    """Coordinates of the farmer's address, used when a crop location is unknown"""
+    if crop.farmer_id is None:
+        return None
+    with session.no_autoflush:
+        farmer = session.get(User, crop.farmer_id)
+    if farmer is None or farmer.latitude is None:
+        return None
+    return farmer.latitude, farmer.longitude
+
+def _backfill(table, rows):
+    """Set coordinates from {id: (latitude, longitude)} without touching updated_at"""
+    params = [{'row_id': row_id, 'lat': point[0], 'lon': point[1]} for row_id, point in rows.items()]
+    if params:
+        db.session.execute(
+            table.update()
+            .where(table.c.id == bindparam('row_id'))
+            .values(latitude=bindparam('lat'), longitude=bindparam('lon'), updated_at=table.c.updated_at),
+            params
+        )
+
+def init_coordinates():
+    """Geocode users and crops saved without coordinates, such as those created before geocoding"""
+    users = {}
+    for user_id, address in (db.session.query(User.id, User.address)
+                             .filter(User.latitude.is_(None), User.address.isnot(None))):
+        point = geocode(address)
+        if point:
+            users[user_id] = point
+    _backfill(User.__table__, users)
+
+    farmer_points = {user_id: (user_latitude, user_longitude) for user_id, user_latitude, user_longitude in
+                     db.session.query(User.id, User.latitude, User.longitude).filter(User.latitude.isnot(None))}
+    crops = {}
+    for crop_id, location, farmer_id in (db.session.query(Crop.id, Crop.location, Crop.farmer_id)
+                                         .filter(Crop.latitude.is_(None))):
+        point = geocode(location) or farmer_points.get(farmer_id)
+        if point:
+            crops[crop_id] = point
+    _backfill(Crop.__table__, crops)
+    db.session.commit()
+
+@event.listens_for(Session, 'before_flush')
+def _geocode_changes(session, flush_context, instances):
+    """Geocode new or edited crop locations and user addresses"""
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Crop):
+            if obj in session.new or inspect(obj).attrs.location.history.has_changes():
+                point = geocode(obj.location) or _farmer_point(session, obj)
+                obj.latitude, obj.longitude = point or (None, None)
+        elif isinstance(obj, User):
+            if obj in session.new or inspect(obj).attrs.address.history.has_changes():
+                obj.latitude, obj.longitude = geocode(obj.address) or (None, None)
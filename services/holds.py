@@ -0,0 +1,191 @@
+"""
+Timed stock holds for cart lines.
+
+When CART_HOLD_MINUTES is set, adding a crop to the cart records that
+quantity in a StockHold row and adds it to Crop.quantity_held, so the
+catalog shows what is really left and checkout rarely fails. The farmer's
+quantity_available is left alone. Holds are refreshed whenever the line
+changes, handed over to the order at checkout, and released by a
+background sweeper once they expire.
+
+Every hold row is claimed with a conditional UPDATE or DELETE before its
+stock is moved, so the sweeper, checkout and cart edits can race freely
+without releasing or consuming the same stock twice. A buyer's first hold
+on a crop is inserted with ON CONFLICT DO NOTHING, so two requests adding
+the same crop at once end up adjusting one row.
+"""
+
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import delete, insert, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+
+from models import StockHold, db
+from services.inventory import InsufficientStock, hold_stock, unhold_stock
+
+# Expired holds released per sweeper transaction
+SWEEP_BATCH = 500
+
+# Seconds between sweeper runs
+SWEEP_INTERVAL = 60
+
+def holds_enabled():
+    """Whether cart lines hold stock (CART_HOLD_MINUTES > 0)"""
+    return current_app.config.get('CART_HOLD_MINUTES', 0) > 0
+
+def held_quantities(user_id, crop_ids):
+    """The buyer's held quantity per crop, as {crop_id: quantity}"""
+    if not crop_ids:
+        return {}
+    return dict(db.session.query(StockHold.crop_id, StockHold.quantity).filter(
+        StockHold.user_id == user_id,
+        StockHold.crop_id.in_(crop_ids)
+    ).all())
+
+def _insert_hold(row):
+    """Insert a hold; False if the buyer already has one on the crop"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        upsert = sqlite_insert if dialect == 'sqlite' else postgresql_insert
+        result = db.session.execute(
+            upsert(StockHold).values(row).on_conflict_do_nothing(index_elements=['user_id', 'crop_id'])
+        )
+        return result.rowcount == 1
+
+    try:
+        db.session.execute(insert(StockHold).values(row))
+    except IntegrityError:
+        return False
+    return True
+
+def _set_hold(user_id, crop_id, target, expires_at):
+    """Move stock so that exactly target is held for this buyer and crop
+
+    Raises InsufficientStock, with this crop's stock and hold unchanged,
+    when more stock is needed than is available.
+    """
+    while True:
+        hold = StockHold.query.filter_by(user_id=user_id, crop_id=crop_id).first()
+        held = hold.quantity if hold else 0
+
+        if target > held:
+            hold_stock([(crop_id, target - held)])
+        elif target < held:
+            unhold_stock([(crop_id, held - target)])
+
+        if hold is None:
+            if target <= 0:
+                return
+            if _insert_hold({'user_id': user_id, 'crop_id': crop_id, 'quantity': target, 'expires_at': expires_at}):
+                return
+            # Another request created the hold first: undo our move and adjust theirs
+            unhold_stock([(crop_id, target)])
+            continue
+
+        if target > 0:
+            claimed = db.session.execute(
+                update(StockHold)
+                .where(StockHold.id == hold.id, StockHold.quantity == held)
+                .values(quantity=target, expires_at=expires_at)
+                .execution_options(synchronize_session=False)
+            )
+        else:
+            claimed = db.session.execute(
+                delete(StockHold)
+                .where(StockHold.id == hold.id, StockHold.quantity == held)
+                .execution_options(synchronize_session=False)
+            )
+        if claimed.rowcount == 1:
+            db.session.expire(hold)
+            return
+
+        # The sweeper released the hold under us: undo our move and start over
+        if target > held:
+            unhold_stock([(crop_id, target - held)])
+        elif target < held:
+            hold_stock([(crop_id, held - target)])
+        db.session.expire(hold)
+
+def set_holds(user_id, quantities):
+    """Hold exactly {crop_id: quantity} for the buyer, 0 releasing the hold
+
+    Each line is held on its own. Returns the crop ids that need more stock
+    than is available, whose holds are left as they were; every other line
+    is held. Does not commit.
+    """
+    expires_at = datetime.utcnow() + timedelta(minutes=current_app.config.get('CART_HOLD_MINUTES', 0))
+    rejected = []
+    for crop_id, quantity in sorted(quantities.items()):
+        try:
+            _set_hold(user_id, crop_id, max(quantity, 0), expires_at)
+        except InsufficientStock:
+            rejected.append(crop_id)
+    return rejected
+
+def consume_holds(user_id, crop_ids):
+    """Release the buyer's holds on crop_ids for an order, as {crop_id: quantity}
+
+    The held stock goes back to the buyer in the same transaction, so the
+    order can reserve it before anyone else. Does not commit.
+    """
+    consumed = {}
+    for hold in StockHold.query.filter(StockHold.user_id == user_id, StockHold.crop_id.in_(crop_ids)).all():
+        claimed = db.session.execute(
+            delete(StockHold)
+            .where(StockHold.id == hold.id, StockHold.quantity == hold.quantity)
+            .execution_options(synchronize_session=False)
+        )
+        if claimed.rowcount == 1:
+            consumed[hold.crop_id] = hold.quantity
+    unhold_stock(consumed.items())
+    return consumed
+
+def sweep_expired_holds(batch_size=SWEEP_BATCH):
+    """Release one batch of expired holds; returns how many were found"""
+    now = datetime.utcnow()
+    holds = (StockHold.query
+             .filter(StockHold.expires_at <= now)
+             .order_by(StockHold.expires_at)
+             .limit(batch_size)
+             .all())
+
+    released = defaultdict(float)
+    for hold in holds:
+        claimed = db.session.execute(
+            delete(StockHold)
+            .where(StockHold.id == hold.id,
+                   StockHold.quantity == hold.quantity,
+                   StockHold.expires_at <= now)
+            .execution_options(synchronize_session=False)
+        )
+        if claimed.rowcount == 1:
+            released[hold.crop_id] += hold.quantity
+
+    unhold_stock(released.items())
+    db.session.commit()
+    return len(holds)
+
+def start_hold_sweeper(app, interval=SWEEP_INTERVAL):
+    """Release expired holds from a daemon thread every interval seconds"""
+    def run():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    while sweep_expired_holds() == SWEEP_BATCH:
+                        pass
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Stock hold sweep failed')
+                finally:
+                    db.session.remove()
+
+    thread = threading.Thread(target=run, name='stock-hold-sweeper', daemon=True)
+    thread.start()
+    return thread
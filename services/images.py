@@ -0,0 +1,135 @@
+"""
+Crop photo storage and thumbnails.
+
+Uploaded originals are stored under UPLOAD_FOLDER by the SHA-256 of their
+content, so the same photo is kept once and an image URL can be cached
+forever. Resized WebP and JPEG thumbnails are rendered right after upload by
+a small background thread pool; if the pool is busy, or a thumbnail is
+missing, it is rendered on its first request instead.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Longest side in pixels of each thumbnail size
+THUMBNAIL_SIZES = {'small': 160, 'card': 480, 'large': 1200}
+
+# Thumbnail formats as (Pillow format, MIME type, save options)
+THUMBNAIL_FORMATS = {
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+ACCEPTED_FORMATS = ('JPEG', 'PNG', 'WEBP', 'GIF')
+
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+
+# Refuse decompression bombs well before Pillow's own limit
+MAX_IMAGE_PIXELS = 40 * 1000 * 1000
+
+THUMBNAIL_WORKERS = 2
+
+# Uploads waiting for thumbnails; beyond this they are rendered on demand
+MAX_PENDING = 32
+
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+class InvalidImage(Exception):
+    """Raised when an upload is not an acceptable image"""
+
+_executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix='thumbnails')
+_pending = threading.BoundedSemaphore(MAX_PENDING)
+
+def image_dir(root, digest):
+    return os.path.join(root, digest[:2], digest)
+
+def save_image(stream, root):
+    """Store an uploaded image stream under its content hash and return the hash"""
+    os.makedirs(root, exist_ok=True)
+    sha256 = hashlib.sha256()
+    size = 0
+
+    with tempfile.NamedTemporaryFile(dir=root, prefix='.upload-', delete=False) as tmp:
+        try:
+            for chunk in iter(lambda: stream.read(64 * 1024), b''):
+                size += len(chunk)
+                if size > MAX_IMAGE_BYTES:
+                    raise InvalidImage(f'Images must be smaller than {MAX_IMAGE_BYTES // (1024 * 1024)} MB.')
+                sha256.update(chunk)
+                tmp.write(chunk)
+        except InvalidImage:
+            tmp.close()
+            os.unlink(tmp.name)
+            raise
+
+    try:
+        with Image.open(tmp.name) as image:
+            if image.format not in ACCEPTED_FORMATS:
+                raise InvalidImage('Please upload a JPEG, PNG, WebP or GIF image.')
+            if image.width * image.height > MAX_IMAGE_PIXELS:
+                raise InvalidImage('This image has too many pixels.')
+            image.verify()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError):
+        os.unlink(tmp.name)
+        raise InvalidImage('This file is not a readable image.')
+    except InvalidImage:
+        os.unlink(tmp.name)
+        raise
+
+    digest = sha256.hexdigest()
+    directory = image_dir(root, digest)
+    os.makedirs(directory, exist_ok=True)
+    original = os.path.join(directory, 'original')
+    if os.path.exists(original):
+        os.unlink(tmp.name)
+    else:
+        os.replace(tmp.name, original)
+    return digest
+
+def render_thumbnail(root, digest, size, fmt):
+    """Path of a thumbnail, rendering it first if needed; None if the image is unknown"""
+    path = os.path.join(image_dir(root, digest), f'{size}.{fmt}')
+    if os.path.exists(path):
+        return path
+
+    original = os.path.join(image_dir(root, digest), 'original')
+    if not os.path.exists(original):
+        return None
+
+    # Two requests may render the same thumbnail at once; the last rename wins
+    pillow_format, _, options = THUMBNAIL_FORMATS[fmt]
+    with Image.open(original) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((THUMBNAIL_SIZES[size], THUMBNAIL_SIZES[size]), Image.LANCZOS)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        # Write beside the final file and rename, so readers never see half a file
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.render-', delete=False) as tmp:
+            image.save(tmp, pillow_format, **options)
+    os.replace(tmp.name, path)
+    return path
+
+def _render_all(root, digest):
+    try:
+        for size in THUMBNAIL_SIZES:
+            for fmt in THUMBNAIL_FORMATS:
+                render_thumbnail(root, digest, size, fmt)
+    finally:
+        _pending.release()
+
+def schedule_thumbnails(root, digest):
+    """Render every thumbnail of an image in the background, unless the pool is full"""
+    if _pending.acquire(blocking=False):
+        _executor.submit(_render_all, root, digest)
+
+def digest_of(image_url):
+    """Content hash of an uploaded image URL, or None for external URLs"""
+    match = re.match(r'^/images/([0-9a-f]{64})/', image_url or '')
+    return match.group(1) if match else None
@@ -0,0 +1,176 @@
+"""
+In-process indexes kept current from committed transactions.
+
+apply_on_commit is the shared plumbing: it gathers changes from every flush
+of a transaction and hands them to an index (or cache) only once the
+transaction commits, dropping them on rollback. In-memory state therefore
+never shows data that was not committed.
+
+CropIndex builds on it for indexes over the active crops: whenever a
+transaction that added, edited, deactivated or deleted a Crop commits,
+every registered index receives the new per-crop values. Indexes are also
+rebuilt periodically so that writes made by other processes (or bulk
+UPDATEs that bypass the ORM) show up.
+
+Only the first build runs in a request. Later rebuilds run on a background
+thread into a separate copy that replaces the live one when it is done, so
+requests keep reading the old index in the meantime.
+"""
+
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import Crop, db
+
+# Seconds after which an index is rebuilt from the database
+REBUILD_INTERVAL = 300
+
+_indexes = []
+
+def apply_on_commit(collect, apply):
+    """Pass what collect(session) returns after each flush to apply once the transaction commits
+
+    collect returns a list of changes, or nothing; apply receives the changes
+    of all flushes of a committed transaction, in flush order.
+    """
+    key = f'{collect.__module__}.{collect.__name__}'
+
+    @event.listens_for(Session, 'after_flush')
+    def _collect(session, flush_context):
+        changes = collect(session)
+        if changes:
+            session.info.setdefault(key, []).extend(changes)
+
+    @event.listens_for(Session, 'after_commit')
+    def _apply(session):
+        changes = session.info.pop(key, None)
+        if changes:
+            apply(changes)
+
+    @event.listens_for(Session, 'after_rollback')
+    def _discard(session):
+        session.info.pop(key, None)
+
+class CropIndex:
+    """Base class for indexes keyed by crop id
+
+    Subclasses list the Crop columns they need in ``columns``, turn those
+    into an indexed value with ``values_of`` (returning None to leave a crop
+    out) and implement ``_reset``, ``_add`` and ``_remove``. ``_load`` can be
+    overridden when filling an empty index in bulk is cheaper than adding
+    crops one by one.
+    """
+
+    columns = ()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._built_at = None
+        self._refreshing = False
+        self._pending = None
+        self._reset()
+        _indexes.append(self)
+
+    def values_of(self, *columns):
+        raise NotImplementedError
+
+    def _reset(self):
+        raise NotImplementedError
+
+    def _add(self, crop_id, values):
+        raise NotImplementedError
+
+    def _remove(self, crop_id):
+        raise NotImplementedError
+
+    def _load(self, entries):
+        """Fill an empty index from (crop_id, values) pairs"""
+        for crop_id, values in entries:
+            self._add(crop_id, values)
+
+    def _apply(self, crops):
+        for crop_id, columns in crops.items():
+            self._remove(crop_id)
+            values = self.values_of(*columns) if columns is not None else None
+            if values is not None:
+                self._add(crop_id, values)
+
+    def rebuild(self):
+        """Reload the index from the active crops in the database"""
+        # Changes committed while the copy is built are replayed onto it
+        with self._lock:
+            self._pending = []
+
+        fresh = object.__new__(type(self))
+        fresh._reset()
+        rows = db.session.query(Crop.id, *self.columns).filter(Crop.is_active == True).yield_per(5000)
+        entries = ((crop_id, fresh.values_of(*columns)) for crop_id, *columns in rows)
+        fresh._load((crop_id, values) for crop_id, values in entries if values is not None)
+
+        with self._lock:
+            for crops in self._pending:
+                fresh._apply(crops)
+            self._pending = None
+            vars(self).update(vars(fresh))
+            self._built_at = time.monotonic()
+
+    def apply(self, crops):
+        """Re-index committed crops given as {crop_id: Crop column values or None}"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(crops)
+            if self._built_at is not None:
+                self._apply(crops)
+
+    def _refresh(self, app):
+        with app.app_context():
+            try:
+                self.rebuild()
+            except Exception:
+                app.logger.exception('Rebuilding %s failed', type(self).__name__)
+            finally:
+                db.session.remove()
+                self._refreshing = False
+
+    def ensure_fresh(self):
+        """Build the index on first use and refresh it in the background once it is stale"""
+        if self._built_at is None:
+            self.rebuild()
+            return
+        if time.monotonic() - self._built_at <= REBUILD_INTERVAL:
+            return
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh, args=(current_app._get_current_object(),),
+                         name=f'{type(self).__name__}-rebuild', daemon=True).start()
+
+def _crop_columns(crop):
+    return {column.key: getattr(crop, column.key) for index in _indexes for column in index.columns}
+
+def _crop_changes(session):
+    """(crop_id, Crop column values or None) of the crops a flush wrote"""
+    changes = []
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Crop):
+            changes.append((obj.id, _crop_columns(obj) if obj.is_active else None))
+    for obj in session.deleted:
+        if isinstance(obj, Crop):
+            changes.append((obj.id, None))
+    return changes
+
+def _apply_crop_changes(changes):
+    # Later flushes of the transaction win
+    latest = dict(changes)
+    for index in _indexes:
+        index.apply({
+            crop_id: None if values is None else tuple(values[column.key] for column in index.columns)
+            for crop_id, values in latest.items()
+        })
+
+apply_on_commit(_crop_changes, _apply_crop_changes)
@@ -0,0 +1,82 @@
+"""
+Race-free stock changes on Crop.quantity_available and Crop.quantity_held.
+
+Stock is never read, checked and written back from Python. Each change is a
+single conditional UPDATE, so concurrent buyers of the same listing cannot
+oversell it and nobody has to hold a lock while a checkout is assembled.
+
+quantity_available is the farmer's stock and only changes when orders are
+placed or cancelled. Cart holds are counted in quantity_held instead, so a
+farmer editing their stock never interferes with them; what buyers can
+still take is the difference.
+"""
+
+from sqlalchemy import update
+
+from models import Crop, db
+
+class InsufficientStock(Exception):
+    """Raised when a crop no longer has the requested quantity available"""
+
+    def __init__(self, crop_id, quantity):
+        super().__init__(f'Crop {crop_id} does not have {quantity} available')
+        self.crop_id = crop_id
+        self.quantity = quantity
+
+def reserve_stock(items):
+    """Decrement stock for every (crop_id, quantity) in the current transaction
+
+    Raises InsufficientStock on the first crop that is inactive or short;
+    the caller must then roll back so that earlier decrements are undone.
+    Crops are updated in id order so concurrent checkouts lock rows in the
+    same order and cannot deadlock each other.
+    """
+    for crop_id, quantity in sorted(items):
+        result = db.session.execute(
+            update(Crop)
+            .where(Crop.id == crop_id,
+                   Crop.is_active == True,
+                   Crop.quantity_available - Crop.quantity_held >= quantity)
+            .values(quantity_available=Crop.quantity_available - quantity)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            raise InsufficientStock(crop_id, quantity)
+
+def hold_stock(items):
+    """Set aside stock for every (crop_id, quantity) in the current transaction
+
+    Raises InsufficientStock like reserve_stock when a crop does not have
+    that much left outside other holds.
+    """
+    for crop_id, quantity in sorted(items):
+        result = db.session.execute(
+            update(Crop)
+            .where(Crop.id == crop_id,
+                   Crop.is_active == True,
+                   Crop.quantity_available - Crop.quantity_held >= quantity)
+            .values(quantity_held=Crop.quantity_held + quantity)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            raise InsufficientStock(crop_id, quantity)
+
+def unhold_stock(items):
+    """Give back held stock for every (crop_id, quantity) in the current transaction"""
+    for crop_id, quantity in sorted(items):
+        db.session.execute(
+            update(Crop)
+            .where(Crop.id == crop_id)
+            .values(quantity_held=Crop.quantity_held - quantity)
+            .execution_options(synchronize_session=False)
+        )
+
+def release_stock(items):
+    """Return stock for every (crop_id, quantity) in the current transaction"""
+    for crop_id, quantity in sorted(items):
+        db.session.execute(
+            update(Crop)
+            .where(Crop.id == crop_id)
+            .values(quantity_available=Crop.quantity_available + quantity)
+            .execution_options(synchronize_session=False)
+        )
@@ -0,0 +1,182 @@
+"""
+Crop price history and the market price index.
+
+Every time a listing is created or its price, name, unit or location
+changes, a crop_prices row records the new price. The market index
+summarises the active listings of one crop name and unit, optionally in
+one district. Each listing counts once, at the price it had at the time,
+however often it was repriced. The index gives quantiles of the current
+prices and the median at the end of each week of the last WINDOW_DAYS, so
+farmers can see going rates while pricing. Results are cached for
+CACHE_SECONDS.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func, inspect, insert, or_, select
+from sqlalchemy.orm import Session
+
+from models import Crop, CropPrice, db
+from services.facets import district_of
+
+# Days of weekly medians the index reports
+WINDOW_DAYS = 90
+
+# Seconds an index is served from memory, and how many are kept
+CACHE_SECONDS = 600
+CACHE_SIZE = 512
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def name_key(name):
+    return (name or '').strip().lower()
+
+def _price_row(crop):
+    return CropPrice(crop=crop, name_key=name_key(crop.name), district=district_of(crop.location),
+                     unit=crop.unit or 'kg', price_per_unit=crop.price_per_unit)
+
+@event.listens_for(Session, 'before_flush')
+def _record_price_changes(session, flush_context, instances):
+    """Append a price history row for new listings and changed prices"""
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Crop) or obj.price_per_unit is None:
+            continue
+        if obj in session.new:
+            session.add(_price_row(obj))
+            continue
+        state = inspect(obj)
+        if any(state.attrs[key].history.has_changes() for key in ('price_per_unit', 'name', 'unit', 'location')):
+            session.add(_price_row(obj))
+
+def init_price_history():
+    """Seed the history with current prices the first time it is used"""
+    if db.session.query(CropPrice.id).first() is not None:
+        return
+
+    crops = db.session.query(Crop.id, Crop.name, Crop.location, Crop.unit, Crop.price_per_unit,
+                             Crop.updated_at).yield_per(5000)
+    batch = []
+    for crop_id, name, location, unit, price, updated_at in crops:
+        batch.append({'crop_id': crop_id, 'name_key': name_key(name), 'district': district_of(location),
+                      'unit': unit or 'kg', 'price_per_unit': price, 'recorded_at': updated_at or datetime.utcnow()})
+        if len(batch) == 5000:
+            db.session.execute(insert(CropPrice), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(CropPrice), batch)
+    db.session.commit()
+
+def _quantile(ordered, q):
+    """Linear-interpolated quantile of a sorted list"""
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+def _quantiles(prices):
+    ordered = sorted(prices)
+    if not ordered:
+        return None
+    return {
+        'min': ordered[0],
+        'p25': round(_quantile(ordered, 0.25), 2),
+        'median': round(_quantile(ordered, 0.5), 2),
+        'p75': round(_quantile(ordered, 0.75), 2),
+        'max': ordered[-1]
+    }
+
+def _compute(name, unit, district):
+    end = datetime.utcnow()
+    start = end - timedelta(days=WINDOW_DAYS)
+    key = name_key(name)
+    district = district_of(district) if district else None
+
+    # Every listing ever priced under this name and unit: its last price
+    # before the window, then its changes during it
+    listed = select(CropPrice.crop_id).where(CropPrice.name_key == key, CropPrice.unit == unit)
+    carried = (select(func.max(CropPrice.id))
+               .where(CropPrice.crop_id.in_(listed), CropPrice.recorded_at < start)
+               .group_by(CropPrice.crop_id))
+    rows = db.session.execute(
+        select(CropPrice.crop_id, CropPrice.recorded_at, CropPrice.name_key, CropPrice.unit,
+               CropPrice.district, CropPrice.price_per_unit)
+        .join(Crop, Crop.id == CropPrice.crop_id)
+        .where(Crop.is_active == True,
+               CropPrice.crop_id.in_(listed),
+               or_(CropPrice.recorded_at >= start, CropPrice.id.in_(carried)))
+        .order_by(CropPrice.recorded_at, CropPrice.id)
+    ).all()
+
+    # Replay the changes, reading every listing's latest price at the end of each week
+    current = {}
+
+    def snapshot():
+        return [(row_district, price) for row_key, row_unit, row_district, price in current.values()
+                if row_key == key and row_unit == unit and (district is None or row_district == district)]
+
+    weekly = []
+    position = 0
+    week_end = start + timedelta(days=7)
+    while week_end <= end + timedelta(days=7):
+        cutoff = min(week_end, end)
+        while position < len(rows) and rows[position].recorded_at < cutoff:
+            crop_id, _, row_key, row_unit, row_district, price = rows[position]
+            current[crop_id] = (row_key, row_unit, row_district, price)
+            position += 1
+        prices = sorted(price for _, price in snapshot())
+        weekly.append({
+            'week': (week_end - timedelta(days=7)).date().isoformat(),
+            'median': round(_quantile(prices, 0.5), 2) if prices else None,
+            'count': len(prices)
+        })
+        week_end += timedelta(days=7)
+
+    for crop_id, _, row_key, row_unit, row_district, price in rows[position:]:
+        current[crop_id] = (row_key, row_unit, row_district, price)
+    listings = snapshot()
+
+    index = {
+        'name': key,
+        'unit': unit,
+        'district': district,
+        'window_days': WINDOW_DAYS,
+        'count': len(listings),
+        'quantiles': _quantiles(price for _, price in listings),
+        'weekly_median': weekly,
+        'districts': []
+    }
+
+    if not district:
+        by_district = {}
+        for row_district, price in listings:
+            by_district.setdefault(row_district, []).append(price)
+        index['districts'] = sorted(
+            ({'district': row_district, 'median': round(_quantile(sorted(prices), 0.5), 2), 'count': len(prices)}
+             for row_district, prices in by_district.items()),
+            key=lambda entry: -entry['count']
+        )
+
+    return index
+
+def market_index(name, unit='kg', district=None):
+    """Price quantiles and weekly medians for a crop name, cached for CACHE_SECONDS"""
+    key = (name_key(name), unit, district_of(district) if district else None)
+    now = time.monotonic()
+
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None and now - cached[0] < CACHE_SECONDS:
+            return cached[1]
+
+    index = _compute(name, unit, district)
+
+    with _cache_lock:
+        _cache[key] = (now, index)
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return index
@@ -0,0 +1,133 @@
+"""
+Streaming export of order history.
+
+Orders are exported one row per order line, as CSV or newline-delimited
+JSON. Rows are read through a server-side cursor in batches of EXPORT_BATCH
+and written out as they arrive, so exporting years of orders takes the same
+memory as exporting one.
+"""
+
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from models import Crop, Order, OrderItem, User, db
+
+# Rows fetched from the database per round trip
+EXPORT_BATCH = 1000
+
+ORDER_STATUSES = ('pending', 'confirmed', 'processing', 'shipped', 'delivered', 'cancelled')
+PAYMENT_STATUSES = ('pending', 'paid', 'failed', 'refunded')
+
+# (field name, column) of every exported row
+EXPORT_COLUMNS = (
+    ('order_number', Order.order_number),
+    ('created_at', Order.created_at),
+    ('status', Order.status),
+    ('payment_status', Order.payment_status),
+    ('payment_method', Order.payment_method),
+    ('order_total', Order.total_amount),
+    ('crop_id', OrderItem.crop_id),
+    ('crop', Crop.name),
+    ('quantity', OrderItem.quantity),
+    ('unit', Crop.unit),
+    ('unit_price', OrderItem.unit_price),
+    ('total_price', OrderItem.total_price),
+)
+
+# Extra fields for exports that span buyers
+BUYER_COLUMNS = (
+    ('buyer', User.username),
+    ('buyer_email', User.email),
+)
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+def _date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+def parse_export_filters(args):
+    """Read start/end dates (YYYY-MM-DD, inclusive), status and payment from request args"""
+    end = _date(args.get('end'))
+    status = args.get('status', '')
+    payment_status = args.get('payment', '')
+    return {
+        'start': _date(args.get('start')),
+        'end': end + timedelta(days=1) if end else None,
+        'status': status if status in ORDER_STATUSES else None,
+        'payment_status': payment_status if payment_status in PAYMENT_STATUSES else None,
+    }
+
+def _rows(buyer_id=None, start=None, end=None, status=None, payment_status=None):
+    """(field names, row iterator) of the matching order lines, oldest first"""
+    columns = EXPORT_COLUMNS if buyer_id else EXPORT_COLUMNS + BUYER_COLUMNS
+
+    statement = (select(*[column for _, column in columns])
+                 .join(OrderItem, OrderItem.order_id == Order.id)
+                 .join(Crop, Crop.id == OrderItem.crop_id)
+                 .order_by(Order.created_at, Order.id, OrderItem.id))
+    if buyer_id:
+        statement = statement.where(Order.buyer_id == buyer_id)
+    else:
+        statement = statement.join(User, User.id == Order.buyer_id)
+    if start:
+        statement = statement.where(Order.created_at >= start)
+    if end:
+        statement = statement.where(Order.created_at < end)
+    if status:
+        statement = statement.where(Order.status == status)
+    if payment_status:
+        statement = statement.where(Order.payment_status == payment_status)
+
+    rows = db.session.execute(statement.execution_options(yield_per=EXPORT_BATCH))
+    return [name for name, _ in columns], rows
+
+def _value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def _csv(names, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(names)
+    for row in rows:
+        writer.writerow([_value(value) for value in row])
+        if buffer.tell() >= 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+def _ndjson(names, rows):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(names, map(_value, row)))))
+        if len(lines) == EXPORT_BATCH:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+def export_orders(fmt, **filters):
+    """Generate order lines in 'csv' or 'ndjson', chunk by chunk
+
+    filters are buyer_id (a single buyer's orders) and those returned by
+    parse_export_filters.
+    """
+    names, rows = _rows(**filters)
+    if fmt == 'ndjson':
+        return _ndjson(names, rows)
+    return _csv(names, rows)
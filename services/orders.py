@@ -0,0 +1,118 @@
+"""
+Order placement and cancellation.
+"""
+
+import time
+import uuid
+from datetime import datetime
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from models import Order, OrderItem, db
+from services.analytics import record_order
+from services.holds import consume_holds
+from services.inventory import InsufficientStock, reserve_stock, release_stock
+
+# Attempts at a checkout transaction that hit a lock timeout or deadlock
+CHECKOUT_ATTEMPTS = 3
+
+# Seconds to wait before the first retry, doubled on every further retry
+RETRY_BACKOFF = 0.05
+
+def _order_number():
+    return f"ORD-{datetime.now().strftime('%Y%m%d')}-{str(uuid.uuid4())[:8].upper()}"
+
+def new_idempotency_key():
+    """Random key the checkout form sends back with its order"""
+    return uuid.uuid4().hex
+
+def find_order_by_key(buyer_id, idempotency_key):
+    """The buyer's order previously placed with idempotency_key, if any"""
+    if not idempotency_key:
+        return None
+    return Order.query.filter_by(buyer_id=buyer_id, idempotency_key=idempotency_key).first()
+
+def _create_order(buyer_id, cart_items, total_amount, shipping_address, payment_method, notes, idempotency_key):
+    # The buyer's holds are given back first, so their stock counts toward this order
+    consume_holds(buyer_id, [item['crop'].id for item in cart_items])
+    reserve_stock([(item['crop'].id, item['quantity']) for item in cart_items])
+
+    order = Order(
+        order_number=_order_number(),
+        total_amount=total_amount,
+        shipping_address=shipping_address,
+        payment_method=payment_method,
+        notes=notes,
+        idempotency_key=idempotency_key,
+        buyer_id=buyer_id
+    )
+    db.session.add(order)
+
+    for item in cart_items:
+        order.items.append(OrderItem(
+            crop_id=item['crop'].id,
+            quantity=item['quantity'],
+            unit_price=item['crop'].price_per_unit,
+            total_price=item['total']
+        ))
+
+    db.session.commit()
+    return order
+
+def place_order(buyer_id, cart_items, total_amount, shipping_address, payment_method, notes='',
+                idempotency_key=None):
+    """Create an order for resolved cart items, all or nothing
+
+    Stock for every line is reserved with conditional UPDATEs in the same
+    transaction as the order, so either the whole order is placed or
+    nothing changes. Raises InsufficientStock if any line is short. Lock
+    timeouts and deadlocks under heavy contention are retried.
+
+    When the same idempotency_key was already used by this buyer, the
+    existing order is returned instead; a concurrent duplicate loses on the
+    unique constraint and its stock reservation is rolled back.
+
+    The buyer's stock holds on the ordered crops are converted into the
+    order rather than released.
+    """
+    for attempt in range(CHECKOUT_ATTEMPTS):
+        try:
+            return _create_order(buyer_id, cart_items, total_amount, shipping_address, payment_method,
+                                 notes, idempotency_key)
+        except InsufficientStock:
+            db.session.rollback()
+            raise
+        except IntegrityError:
+            db.session.rollback()
+            existing = find_order_by_key(buyer_id, idempotency_key)
+            if existing is None:
+                raise
+            return existing
+        except OperationalError:
+            db.session.rollback()
+            if attempt + 1 == CHECKOUT_ATTEMPTS:
+                raise
+            time.sleep(RETRY_BACKOFF * (2 ** attempt))
+
+def cancel_order(order):
+    """Cancel an order and return its stock; False if it can no longer be cancelled
+
+    The status change is a conditional UPDATE, so two concurrent cancel
+    requests cannot both restore the stock.
+    """
+    result = db.session.execute(
+        update(Order)
+        .where(Order.id == order.id,
+               Order.status.notin_(['shipped', 'delivered', 'cancelled']))
+        .values(status='cancelled', updated_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        db.session.rollback()
+        return False
+
+    release_stock([(item.crop_id, item.quantity) for item in order.items])
+    record_order(order, -1)
+    db.session.commit()
+    return True
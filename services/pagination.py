@@ -0,0 +1,76 @@
+"""
+Keyset (cursor) pagination helpers.
+
+Instead of OFFSET, each page continues strictly after the sort key of the
+last row of the previous page, so fetching page 1000 costs the same as
+fetching page 1 and rows inserted meanwhile never shift the pages.
+"""
+
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, or_, DateTime
+
+def encode_cursor(values):
+    """Turn the sort key of a row into an opaque URL-safe token"""
+    payload = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_values(token, length):
+    """Parse a token produced by encode_cursor into its raw values, or None if invalid"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != length:
+        return None
+    return values
+
+def decode_cursor(token, keys):
+    """Parse a token produced by encode_cursor for keys, or return None if it is invalid"""
+    values = decode_values(token, len(keys))
+    if values is None:
+        return None
+    try:
+        return [
+            datetime.fromisoformat(value) if isinstance(column.type, DateTime) and value is not None else value
+            for (column, _), value in zip(keys, values)
+        ]
+    except (ValueError, TypeError):
+        return None
+
+def _after(keys, values):
+    """Build the WHERE clause selecting rows that sort after values"""
+    clauses = []
+    for i, (column, descending) in enumerate(keys):
+        equal = [keys[j][0] == values[j] for j in range(i)]
+        step = column < values[i] if descending else column > values[i]
+        clauses.append(and_(*equal, step))
+    return or_(*clauses)
+
+def keyset_page(query, keys, cursor=None, per_page=20):
+    """Fetch one page of query ordered by keys, starting after cursor
+
+    keys is a list of (column, descending) pairs; the last one must be unique
+    (normally the primary key) so the order is total. Returns the page items
+    and the cursor of the next page, which is None on the last page.
+    """
+    values = decode_cursor(cursor, keys) if cursor else None
+    if values is not None:
+        query = query.filter(_after(keys, values))
+
+    ordering = [column.desc() if descending else column.asc() for column, descending in keys]
+    rows = (query.order_by(None)
+            .order_by(*ordering)
+            .add_columns(*[column for column, _ in keys])
+            .limit(per_page + 1)
+            .all())
+
+    items = [row[0] for row in rows[:per_page]]
+    next_cursor = None
+    if len(rows) > per_page:
+        next_cursor = encode_cursor(list(rows[per_page - 1][1:]))
+
+    return items, next_cursor
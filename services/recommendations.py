@@ -0,0 +1,170 @@
+"""
+"Frequently bought together" recommendations.
+
+Crops are related by name (case-insensitive), so listings of the same crop
+by different farmers share their history. A sparse, symmetric co-occurrence
+matrix counts in how many orders each pair of crop names was bought
+together; it is stored as a dict of Counters holding only non-zero cells.
+The matrix is built from OrderItem once and then counts each order line as
+it commits (see services.indexing.apply_on_commit). It is recounted every
+REBUILD_INTERVAL, which also picks up orders placed by other processes.
+
+The top names for a crop are cached, so serving suggestions is a dictionary
+lookup plus one query for the listings to show.
+"""
+
+import heapq
+import threading
+import time
+from collections import Counter, defaultdict
+
+from sqlalchemy import func, select
+
+from models import Crop, OrderItem, db
+from services.indexing import apply_on_commit
+
+# Most suggestions cached per crop name
+MAX_SUGGESTIONS = 10
+
+# Seconds after which the matrix is rebuilt from the database
+REBUILD_INTERVAL = 3600
+
+def _key(name):
+    return (name or '').strip().lower()
+
+class CoOccurrence:
+    """Sparse symmetric counts of crop names bought in the same order"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(Counter)
+        self._top = {}
+        self._built_at = None
+
+    def _add_pair(self, a, b):
+        self._counts[a][b] += 1
+        self._counts[b][a] += 1
+        self._top.pop(a, None)
+        self._top.pop(b, None)
+
+    def rebuild(self):
+        """Recount every order from the database"""
+        rows = (db.session.query(OrderItem.order_id, func.lower(func.trim(Crop.name)))
+                .join(Crop, Crop.id == OrderItem.crop_id)
+                .order_by(OrderItem.order_id)
+                .yield_per(5000))
+
+        counts = defaultdict(Counter)
+        current, names = None, set()
+        for order_id, name in rows:
+            if order_id != current:
+                _count_order(counts, names)
+                current, names = order_id, set()
+            names.add(name)
+        _count_order(counts, names)
+
+        with self._lock:
+            self._counts = counts
+            self._top = {}
+            self._built_at = time.monotonic()
+
+    def apply(self, orders):
+        """Count newly committed lines, given as [(new names, all names of the order)]"""
+        with self._lock:
+            if self._built_at is None:
+                return
+            for new_names, all_names in orders:
+                for a in new_names:
+                    for b in all_names:
+                        # Pairs of two new names are seen twice; count them once
+                        if a != b and (b not in new_names or a < b):
+                            self._add_pair(a, b)
+
+    def ensure_fresh(self):
+        if self._built_at is None or time.monotonic() - self._built_at > REBUILD_INTERVAL:
+            self.rebuild()
+
+    def related(self, name):
+        """[(other name, count)] most often bought with name, best first"""
+        self.ensure_fresh()
+        key = _key(name)
+        with self._lock:
+            top = self._top.get(key)
+            if top is None:
+                top = heapq.nlargest(MAX_SUGGESTIONS, self._counts.get(key, {}).items(),
+                                     key=lambda item: (item[1], item[0]))
+                self._top[key] = top
+            return top
+
+def _count_order(counts, names):
+    names = sorted(names)
+    for i, a in enumerate(names):
+        for b in names[i + 1:]:
+            counts[a][b] += 1
+            counts[b][a] += 1
+
+co_occurrence = CoOccurrence()
+
+def _listings(names, exclude_ids=()):
+    """The newest active listing of each crop name, as {name: Crop}"""
+    if not names:
+        return {}
+    newest = (select(func.max(Crop.id))
+              .where(Crop.is_active == True,
+                     Crop.quantity_available > Crop.quantity_held,
+                     func.lower(func.trim(Crop.name)).in_(names),
+                     Crop.id.notin_(exclude_ids))
+              .group_by(func.lower(func.trim(Crop.name))))
+    return {_key(crop.name): crop for crop in Crop.query.filter(Crop.id.in_(newest))}
+
+def bought_together(crop, k=4):
+    """Up to k listings of the crops most often bought with crop"""
+    names = [name for name, _ in co_occurrence.related(crop.name)[:k]]
+    listings = _listings(names, exclude_ids=[crop.id])
+    return [listings[name] for name in names if name in listings]
+
+def cart_suggestions(crops, k=4):
+    """Up to k listings most often bought with the crops in a cart"""
+    in_cart = {_key(crop.name) for crop in crops}
+    scores = Counter()
+    for name in in_cart:
+        for other, count in co_occurrence.related(name)[:k]:
+            if other not in in_cart:
+                scores[other] += count
+
+    names = [name for name, _ in scores.most_common(k)]
+    listings = _listings(names, exclude_ids=[crop.id for crop in crops])
+    return [listings[name] for name in names if name in listings]
+
+def _order_lines(session):
+    """(new names, all names) of the orders a flush added lines to
+
+    Names the order already had before the flush are not new, so adding a
+    second line of a crop, or lines spread over several flushes, never
+    counts a pair twice.
+    """
+    new_lines = defaultdict(set)
+    for obj in session.new:
+        if isinstance(obj, OrderItem):
+            new_lines[obj.order_id].add(obj.id)
+    if not new_lines:
+        return []
+
+    rows = session.execute(
+        select(OrderItem.order_id, OrderItem.id, func.lower(func.trim(Crop.name)))
+        .join(Crop, Crop.id == OrderItem.crop_id)
+        .where(OrderItem.order_id.in_(new_lines.keys()))
+    ).all()
+
+    orders = defaultdict(lambda: (set(), set(), set()))
+    for order_id, line_id, name in rows:
+        added, existing, all_names = orders[order_id]
+        all_names.add(name)
+        if line_id in new_lines[order_id]:
+            added.add(name)
+        else:
+            existing.add(name)
+
+    return [(added - existing, all_names) for added, existing, all_names in orders.values()]
+
+apply_on_commit(_order_lines, co_occurrence.apply)
@@ -0,0 +1,177 @@
+"""
+Automatic routing of consultation requests to consultants.
+
+Every active consultant gets a score per category: their smoothed average
+rating in that category, plus a bonus for experience there, minus a penalty
+for each consultation they currently have open. Consultants at
+MAX_OPEN_CONSULTATIONS are not offered more work.
+
+The scores live in a RoutingIndex holding one max-heap per category. When a
+consultant's workload changes, fresh heap entries are pushed and the old
+ones are skipped lazily when they reach the top, so picking the best
+consultant for a request and updating their load are both O(log n) in the
+number of consultants.
+
+A background thread routes the queue in batches of ROUTING_BATCH, most
+urgent first. Requests stay unclaimed for ROUTE_AFTER so consultants can
+pick them up themselves; an admin can route everything waiting at once.
+Each one is assigned with the same conditional UPDATE as a manual claim, so
+routing never overrides a consultant who got there first.
+"""
+
+import heapq
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import case, func
+
+from models import Consultation, User, db
+from services.consultation_queue import QUEUE_KEYS, take, unclaimed_query
+from services.consultations import invalidate
+
+# Consultations assigned per routing transaction
+ROUTING_BATCH = 100
+
+# How long a request waits in the queue before it is routed
+ROUTE_AFTER = timedelta(minutes=10)
+
+# Open consultations beyond which a consultant gets no more work
+MAX_OPEN_CONSULTATIONS = 15
+
+# Rating assumed for a consultant, weighted as this many ratings, before
+# they have been rated in a category
+PRIOR_RATING = 3.5
+PRIOR_WEIGHT = 3
+
+# Score bonus per log of completed consultations in the category
+EXPERIENCE_WEIGHT = 0.5
+
+# Score penalty per open consultation
+LOAD_WEIGHT = 0.25
+
+def routing_interval():
+    """Seconds between background routing runs (CONSULTATION_ROUTING_SECONDS); 0 disables routing"""
+    return current_app.config.get('CONSULTATION_ROUTING_SECONDS', 0)
+
+class RoutingIndex:
+    """Per-category heaps of consultant scores that follow their open workload"""
+
+    def __init__(self, performance, loads):
+        # performance is {(consultant_id, category): (completed, rated, rating_total)}
+        self.performance = performance
+        self.loads = dict(loads)
+        self.heaps = {}
+
+    def score(self, consultant_id, category):
+        completed, rated, rating_total = self.performance.get((consultant_id, category), (0, 0, 0))
+        rating = (rating_total + PRIOR_RATING * PRIOR_WEIGHT) / (rated + PRIOR_WEIGHT)
+        return (rating
+                + EXPERIENCE_WEIGHT * math.log1p(completed)
+                - LOAD_WEIGHT * self.loads[consultant_id])
+
+    def _entry(self, consultant_id, category):
+        # Entries carry the load they were scored with; any other load makes them stale
+        return (-self.score(consultant_id, category), consultant_id, self.loads[consultant_id])
+
+    def _heap(self, category):
+        heap = self.heaps.get(category)
+        if heap is None:
+            heap = [self._entry(consultant_id, category) for consultant_id in self.loads
+                    if self.loads[consultant_id] < MAX_OPEN_CONSULTATIONS]
+            heapq.heapify(heap)
+            self.heaps[category] = heap
+        return heap
+
+    def best(self, category):
+        """The best-scoring consultant with room for a category, or None"""
+        heap = self._heap(category)
+        while heap:
+            _, consultant_id, load = heap[0]
+            if load == self.loads[consultant_id]:
+                return consultant_id
+            heapq.heappop(heap)
+        return None
+
+    def add_load(self, consultant_id, delta=1):
+        """Change a consultant's open workload and rescore them"""
+        self.loads[consultant_id] += delta
+        if self.loads[consultant_id] >= MAX_OPEN_CONSULTATIONS:
+            return
+        for category, heap in self.heaps.items():
+            heapq.heappush(heap, self._entry(consultant_id, category))
+
+def build_index():
+    """A RoutingIndex of every active consultant, with their performance and load from GROUP BY queries"""
+    consultant_ids = [consultant_id for consultant_id, in db.session.query(User.id)
+                      .filter(User.role == 'consultant', User.is_active == True)]
+    if not consultant_ids:
+        return RoutingIndex({}, {})
+
+    performance = {
+        (consultant_id, category): (completed or 0, rated, rating_total or 0)
+        for consultant_id, category, completed, rated, rating_total in (
+            db.session.query(Consultation.consultant_id, Consultation.category,
+                             func.sum(case((Consultation.status == 'completed', 1), else_=0)),
+                             func.count(Consultation.rating),
+                             func.sum(Consultation.rating))
+            .filter(Consultation.consultant_id.in_(consultant_ids))
+            .group_by(Consultation.consultant_id, Consultation.category))
+    }
+
+    loads = dict.fromkeys(consultant_ids, 0)
+    loads.update(db.session.query(Consultation.consultant_id, func.count(Consultation.id))
+                 .filter(Consultation.consultant_id.in_(consultant_ids),
+                         Consultation.status.in_(['pending', 'in_progress']))
+                 .group_by(Consultation.consultant_id)
+                 .all())
+
+    return RoutingIndex(performance, loads)
+
+def route_pending(batch_size=ROUTING_BATCH, min_age=ROUTE_AFTER):
+    """Assign one batch of consultations waiting at least min_age; returns {consultation_id: consultant_id}"""
+    waiting = unclaimed_query()
+    if min_age:
+        waiting = waiting.filter(Consultation.created_at <= datetime.utcnow() - min_age)
+    waiting = (waiting
+               .with_entities(Consultation.id, Consultation.category)
+               .order_by(*[column for column, _ in QUEUE_KEYS])
+               .limit(batch_size)
+               .all())
+    if not waiting:
+        return {}
+
+    index = build_index()
+    assigned = {}
+    for consultation_id, category in waiting:
+        consultant_id = index.best(category)
+        if consultant_id is None:
+            continue
+        if take(consultant_id, consultation_id):
+            assigned[consultation_id] = consultant_id
+            index.add_load(consultant_id)
+
+    db.session.commit()
+    invalidate(set(assigned.values()))
+    return assigned
+
+def start_consultation_router(app, interval):
+    """Route waiting consultations from a daemon thread every interval seconds"""
+    def run():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    while len(route_pending()) == ROUTING_BATCH:
+                        pass
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Consultation routing failed')
+                finally:
+                    db.session.remove()
+
+    thread = threading.Thread(target=run, name='consultation-router', daemon=True)
+    thread.start()
+    return thread
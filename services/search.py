@@ -0,0 +1,123 @@
+"""
+Full-text search over the crop catalog.
+
+SQLite uses an external-content FTS5 table kept in sync with ``crops`` by
+triggers; PostgreSQL uses a generated ``tsvector`` column with a GIN index.
+Both stem English words and treat every search term as a prefix, so partial
+words typed into the search box still match.
+"""
+
+import re
+
+from sqlalchemy import text, func, literal_column
+
+from models import Crop, db
+
+SQLITE_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS crops_fts USING fts5(
+        name, variety, description, location,
+        content='crops', content_rowid='id', tokenize='porter unicode61'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS crops_fts_ai AFTER INSERT ON crops BEGIN
+        INSERT INTO crops_fts(rowid, name, variety, description, location)
+        VALUES (new.id, new.name, new.variety, new.description, new.location);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS crops_fts_ad AFTER DELETE ON crops BEGIN
+        INSERT INTO crops_fts(crops_fts, rowid, name, variety, description, location)
+        VALUES ('delete', old.id, old.name, old.variety, old.description, old.location);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS crops_fts_au AFTER UPDATE OF name, variety, description, location ON crops BEGIN
+        INSERT INTO crops_fts(crops_fts, rowid, name, variety, description, location)
+        VALUES ('delete', old.id, old.name, old.variety, old.description, old.location);
+        INSERT INTO crops_fts(rowid, name, variety, description, location)
+        VALUES (new.id, new.name, new.variety, new.description, new.location);
+    END""",
+]
+
+POSTGRES_DDL = [
+    """ALTER TABLE crops ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(name, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(variety, '')), 'B') ||
+            setweight(to_tsvector('english', coalesce(location, '')), 'C') ||
+            setweight(to_tsvector('english', coalesce(description, '')), 'D')
+        ) STORED""",
+    "CREATE INDEX IF NOT EXISTS ix_crops_search_vector ON crops USING GIN (search_vector)",
+]
+
+# Engines whose index has already been created in this process
+_ready_engines = set()
+
+def _dialect():
+    return db.engine.dialect.name
+
+def _terms(search):
+    """Split user input into lowercase word tokens"""
+    return re.findall(r'\w+', search.lower())
+
+def init_search_index():
+    """Create the crop full-text index and its sync triggers if missing"""
+    dialect = _dialect()
+
+    with db.engine.begin() as conn:
+        if dialect == 'sqlite':
+            exists = conn.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'crops_fts'"
+            )).first()
+            for statement in SQLITE_DDL:
+                conn.execute(text(statement))
+            if not exists:
+                # Index rows that were inserted before the triggers existed
+                conn.execute(text("INSERT INTO crops_fts(crops_fts) VALUES ('rebuild')"))
+        elif dialect == 'postgresql':
+            for statement in POSTGRES_DDL:
+                conn.execute(text(statement))
+
+    _ready_engines.add(db.engine.url)
+
+def _like_search(query, search):
+    """Fallback substring match for databases without a full-text index"""
+    return query.filter(
+        (Crop.name.contains(search)) |
+        (Crop.description.contains(search)) |
+        (Crop.location.contains(search))
+    )
+
+def match_crops(query, search):
+    """Restrict a Crop query to full-text matches
+
+    Returns the filtered query and a (rank, descending) sort key, or None
+    as the key when the database has no full-text index.
+    """
+    terms = _terms(search)
+    dialect = _dialect()
+
+    if not terms or dialect not in ('sqlite', 'postgresql'):
+        return _like_search(query, search), None
+
+    if db.engine.url not in _ready_engines:
+        init_search_index()
+
+    if dialect == 'sqlite':
+        # Quote every term so FTS5 operators in user input are taken literally
+        match = ' '.join(f'"{term}"*' for term in terms)
+        matches = text(
+            "SELECT rowid AS crop_id, bm25(crops_fts, 10.0, 5.0, 1.0, 2.0) AS rank "
+            "FROM crops_fts WHERE crops_fts MATCH :match"
+        ).bindparams(match=match).columns(crop_id=db.Integer, rank=db.Float).subquery('crop_matches')
+
+        # bm25() is lower for better matches
+        return query.join(matches, Crop.id == matches.c.crop_id), (matches.c.rank, False)
+
+    tsquery = func.to_tsquery('english', ' & '.join(f'{term}:*' for term in terms))
+    vector = literal_column('crops.search_vector')
+    return query.filter(vector.op('@@')(tsquery)), (func.ts_rank_cd(vector, tsquery), True)
+
+def search_crops(query, search):
+    """Restrict a Crop query to full-text matches, best matches first"""
+    query, rank_key = match_crops(query, search)
+    if rank_key is None:
+        return query
+
+    rank, descending = rank_key
+    return query.order_by(rank.desc() if descending else rank.asc())
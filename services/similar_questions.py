@@ -0,0 +1,190 @@
+"""
+Similar-question lookup over answered consultations.
+
+Completed consultations with a response are indexed as sparse term vectors
+(title, description and response, the title counted TITLE_WEIGHT times) in
+an in-memory inverted index, and a question is matched against them with
+BM25. Scoring only walks the postings of the question's own terms, so a
+lookup stays fast while the farmer types.
+
+The index is built from the database on first use. Answering, editing,
+reopening or deleting a consultation re-indexes it when the transaction
+commits (see services.indexing.apply_on_commit). A full rebuild every
+REBUILD_INTERVAL catches answers written by other processes.
+"""
+
+import heapq
+import math
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+from sqlalchemy import inspect
+
+from models import Consultation, db
+from services.indexing import apply_on_commit
+
+# BM25 term saturation and length normalisation
+K1 = 1.5
+B = 0.75
+
+# How many times title words count
+TITLE_WEIGHT = 2
+
+# Matches scoring below this are not worth showing
+MIN_SCORE = 1.0
+
+# Seconds after which the index is rebuilt from the database
+REBUILD_INTERVAL = 3600
+
+# Fields whose changes re-index a consultation
+INDEXED_FIELDS = ('title', 'description', 'response', 'status')
+
+STOP_WORDS = frozenset('''
+    a about after all also am an and any are as at be because been before being but by can could did do
+    does doing for from had has have having how i if in into is it its just me more most my no not of on
+    or our out should so some such than that the their them then there these they this to too very was
+    we were what when where which while who why will with would you your please help need want
+'''.split())
+
+def tokens(text):
+    """Lowercase word tokens without stop words, plurals folded to the singular"""
+    words = []
+    for word in re.findall(r'[^\W\d_]{2,}', (text or '').lower()):
+        if word in STOP_WORDS:
+            continue
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        words.append(word)
+    return words
+
+def document_terms(title, description, response):
+    """Term frequencies of a consultation, as a Counter"""
+    terms = Counter(tokens(description) + tokens(response))
+    for word in tokens(title):
+        terms[word] += TITLE_WEIGHT
+    return terms
+
+def _answered(status, response):
+    return status == 'completed' and bool((response or '').strip())
+
+class QuestionIndex:
+    """BM25 inverted index of answered consultations"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = defaultdict(dict)  # term -> {consultation id: frequency}
+        self._documents = {}  # consultation id -> its term Counter
+        self._lengths = {}
+        self._total_length = 0
+        self._built_at = None
+
+    def _remove(self, consultation_id):
+        terms = self._documents.pop(consultation_id, None)
+        if terms is None:
+            return
+        self._total_length -= self._lengths.pop(consultation_id)
+        for term in terms:
+            postings = self._postings[term]
+            postings.pop(consultation_id, None)
+            if not postings:
+                del self._postings[term]
+
+    def _add(self, consultation_id, terms):
+        self._documents[consultation_id] = terms
+        self._lengths[consultation_id] = sum(terms.values())
+        self._total_length += self._lengths[consultation_id]
+        for term, frequency in terms.items():
+            self._postings[term][consultation_id] = frequency
+
+    def rebuild(self):
+        """Index every answered consultation from the database"""
+        rows = (db.session.query(Consultation.id, Consultation.title, Consultation.description, Consultation.response)
+                .filter(Consultation.status == 'completed', Consultation.response.isnot(None))
+                .yield_per(2000))
+
+        index = QuestionIndex()
+        for consultation_id, title, description, response in rows:
+            if _answered('completed', response):
+                index._add(consultation_id, document_terms(title, description, response))
+
+        with self._lock:
+            self._postings = index._postings
+            self._documents = index._documents
+            self._lengths = index._lengths
+            self._total_length = index._total_length
+            self._built_at = time.monotonic()
+
+    def apply(self, changes):
+        """Apply committed changes, given as [(consultation id, term Counter or None to drop it)]"""
+        with self._lock:
+            if self._built_at is None:
+                return
+            for consultation_id, terms in changes:
+                self._remove(consultation_id)
+                if terms:
+                    self._add(consultation_id, terms)
+
+    def ensure_fresh(self):
+        if self._built_at is None or time.monotonic() - self._built_at > REBUILD_INTERVAL:
+            self.rebuild()
+
+    def search(self, text, k=5, exclude_id=None):
+        """[(consultation id, score)] of the k best matches for text, best first"""
+        self.ensure_fresh()
+        query = set(tokens(text))
+
+        with self._lock:
+            count = len(self._documents)
+            if not query or not count:
+                return []
+            average_length = self._total_length / count
+
+            scores = defaultdict(float)
+            for term in query:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for consultation_id, frequency in postings.items():
+                    norm = K1 * (1 - B + B * self._lengths[consultation_id] / average_length)
+                    scores[consultation_id] += idf * frequency * (K1 + 1) / (frequency + norm)
+
+        scores.pop(exclude_id, None)
+        best = heapq.nlargest(k, scores.items(), key=lambda item: (item[1], item[0]))
+        return [(consultation_id, score) for consultation_id, score in best if score >= MIN_SCORE]
+
+question_index = QuestionIndex()
+
+def similar_questions(text, k=5, exclude_id=None):
+    """Up to k answered consultations most similar to text, best first"""
+    matches = question_index.search(text, k, exclude_id)
+    if not matches:
+        return []
+    consultations = {consultation.id: consultation for consultation in
+                     Consultation.query.filter(Consultation.id.in_([consultation_id for consultation_id, _ in matches]))}
+    return [consultations[consultation_id] for consultation_id, _ in matches if consultation_id in consultations]
+
+def _answer_changes(session):
+    """(consultation id, term Counter or None) of the consultations a flush re-indexes"""
+    changes = []
+    for obj in session.new:
+        if isinstance(obj, Consultation) and _answered(obj.status, obj.response):
+            changes.append((obj.id, document_terms(obj.title, obj.description, obj.response)))
+    for obj in session.dirty:
+        if not isinstance(obj, Consultation):
+            continue
+        state = inspect(obj)
+        if not any(state.attrs[key].history.has_changes() for key in INDEXED_FIELDS):
+            continue
+        if _answered(obj.status, obj.response):
+            changes.append((obj.id, document_terms(obj.title, obj.description, obj.response)))
+        else:
+            changes.append((obj.id, None))
+    for obj in session.deleted:
+        if isinstance(obj, Consultation):
+            changes.append((obj.id, None))
+    return changes
+
+apply_on_commit(_answer_changes, question_index.apply)
@@ -0,0 +1,176 @@
+"""
+Consultation response-time metrics.
+
+Two latencies are tracked for every consultation: claim latency, from the
+request to a consultant taking it on (each claim counts, so a request that
+is unassigned and claimed again, or reassigned by an admin, adds another
+sample), and resolution latency, from the request to its completion.
+
+Each latency is added to log-scale sketches for all consultations, for its
+category and for its consultant. A sketch stores how many latencies fell in
+each bucket, where bucket i covers (GAMMA^(i-1), GAMMA^i] seconds, so any
+percentile read back is within RELATIVE_ACCURACY of the true one. Buckets
+live in latency_buckets and are updated with upserts in the same
+transaction as the change that caused them. Reports then read a few
+hundred bucket rows instead of scanning every consultation.
+
+ORM changes to claimed_at and completed_at are picked up by a before_flush
+listener; code that claims consultations with bulk UPDATEs must call
+record_claims itself.
+"""
+
+import math
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from sqlalchemy import event, inspect, insert, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from models import Consultation, LatencyBucket, db
+
+METRICS = ('claim', 'resolution')
+SCOPES = ('all', 'category', 'consultant')
+PERCENTILES = (50, 90, 99)
+
+RELATIVE_ACCURACY = 0.02
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+
+def bucket_of(seconds):
+    """Sketch bucket of a latency; everything up to a second shares bucket 0"""
+    if seconds <= 1:
+        return 0
+    return math.ceil(math.log(seconds) / math.log(GAMMA))
+
+def bucket_value(bucket):
+    """The latency, in seconds, that represents a bucket"""
+    if bucket <= 0:
+        return 1.0
+    return 2 * GAMMA ** bucket / (GAMMA + 1)
+
+def _add_sample(counts, metric, category, consultant_id, started, ended):
+    if started is None or ended is None:
+        return
+    bucket = bucket_of(max((ended - started).total_seconds(), 0))
+    counts[(metric, 'all', '', bucket)] += 1
+    counts[(metric, 'category', category or '', bucket)] += 1
+    if consultant_id is not None:
+        counts[(metric, 'consultant', str(consultant_id), bucket)] += 1
+
+def _apply_counts(session, counts):
+    """Add {(metric, scope, scope_key, bucket): count} to the sketches with upserts"""
+    rows = [
+        {'metric': metric, 'scope': scope, 'scope_key': scope_key, 'bucket': bucket, 'count': count}
+        for (metric, scope, scope_key, bucket), count in counts.items()
+    ]
+    if not rows:
+        return
+
+    dialect = session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        upsert = sqlite_insert if dialect == 'sqlite' else postgresql_insert
+        statement = upsert(LatencyBucket).values(rows)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=['metric', 'scope', 'scope_key', 'bucket'],
+            set_={'count': LatencyBucket.count + statement.excluded.count}
+        ))
+        return
+
+    with session.no_autoflush:
+        for row in rows:
+            updated = session.execute(
+                LatencyBucket.__table__.update()
+                .where(LatencyBucket.metric == row['metric'],
+                       LatencyBucket.scope == row['scope'],
+                       LatencyBucket.scope_key == row['scope_key'],
+                       LatencyBucket.bucket == row['bucket'])
+                .values(count=LatencyBucket.count + row['count'])
+            )
+            if updated.rowcount == 0:
+                session.execute(insert(LatencyBucket).values(row))
+
+def record_claims(consultation_ids):
+    """Add the claim latency of consultations claimed with bulk UPDATEs"""
+    if not consultation_ids:
+        return
+    rows = db.session.execute(
+        select(Consultation.category, Consultation.consultant_id, Consultation.created_at, Consultation.claimed_at)
+        .where(Consultation.id.in_(consultation_ids))
+    ).all()
+
+    counts = Counter()
+    for category, consultant_id, created_at, claimed_at in rows:
+        _add_sample(counts, 'claim', category, consultant_id, created_at, claimed_at)
+    _apply_counts(db.session, counts)
+
+def _newly_set(state, key, replacing=False):
+    """Whether a timestamp was set in this flush: from empty, or also over an earlier time when replacing"""
+    history = state.attrs[key].history
+    if not history.added or history.added[0] is None:
+        return False
+    if replacing:
+        return not history.deleted or history.deleted[0] != history.added[0]
+    return not any(history.deleted)
+
+@event.listens_for(Session, 'before_flush')
+def _record_latencies(session, flush_context, instances):
+    """Turn newly set claim and completion times into sketch samples"""
+    counts = Counter()
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Consultation):
+            continue
+        state = inspect(obj)
+        created_at = obj.created_at or datetime.utcnow()
+        # A reassignment sets a new claim time over the old one
+        if _newly_set(state, 'claimed_at', replacing=True):
+            _add_sample(counts, 'claim', obj.category, obj.consultant_id, created_at, obj.claimed_at)
+        if _newly_set(state, 'completed_at'):
+            _add_sample(counts, 'resolution', obj.category, obj.consultant_id, created_at, obj.completed_at)
+
+    if counts:
+        with session.no_autoflush:
+            _apply_counts(session, counts)
+
+def init_latency_sketches():
+    """Fill the sketches from existing consultations the first time they are used"""
+    if db.session.query(LatencyBucket.id).first() is not None:
+        return
+
+    rows = (db.session.query(Consultation.category, Consultation.consultant_id, Consultation.created_at,
+                             Consultation.claimed_at, Consultation.completed_at)
+            .filter((Consultation.claimed_at.isnot(None)) | (Consultation.completed_at.isnot(None)))
+            .yield_per(5000))
+
+    counts = Counter()
+    for category, consultant_id, created_at, claimed_at, completed_at in rows:
+        _add_sample(counts, 'claim', category, consultant_id, created_at, claimed_at)
+        _add_sample(counts, 'resolution', category, consultant_id, created_at, completed_at)
+    _apply_counts(db.session, counts)
+    db.session.commit()
+
+def _percentiles(buckets):
+    """{'count', 'p50', 'p90', 'p99'} in seconds from [(bucket, count)] sorted by bucket"""
+    total = sum(count for _, count in buckets)
+    result = {'count': total}
+    for percentile in PERCENTILES:
+        # Nearest rank: the smallest bucket holding at least this share of the samples
+        rank = max(1, math.ceil(total * percentile / 100))
+        seen = 0
+        for bucket, count in buckets:
+            seen += count
+            if seen >= rank:
+                result[f'p{percentile}'] = bucket_value(bucket)
+                break
+    return result
+
+def latency_percentiles(metric, scope):
+    """{scope_key: {'count', 'p50', 'p90', 'p99'}} of one metric, latencies in seconds"""
+    rows = (db.session.query(LatencyBucket.scope_key, LatencyBucket.bucket, LatencyBucket.count)
+            .filter(LatencyBucket.metric == metric, LatencyBucket.scope == scope, LatencyBucket.count > 0)
+            .order_by(LatencyBucket.scope_key, LatencyBucket.bucket))
+
+    buckets = defaultdict(list)
+    for scope_key, bucket, count in rows:
+        buckets[scope_key].append((bucket, count))
+    return {scope_key: _percentiles(sketch) for scope_key, sketch in buckets.items()}
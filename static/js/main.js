@@ -150,13 +150,12 @@ document.addEventListener('DOMContentLoaded', function() {
             .then(data => {
                 if (data.success) {
                     // Show success message
-                    showNotification('Item added to cart!', 'success');
+                    showNotification(data.message || 'Item added to cart!', 'success');
                     
                     // Update cart count if element exists
                     const cartCount = document.getElementById('cart-count');
-                    if (cartCount) {
-                        const currentCount = parseInt(cartCount.textContent) || 0;
-                        cartCount.textContent = currentCount + 1;
+                    if (cartCount && data.cart_count !== undefined) {
+                        cartCount.textContent = data.cart_count;
                     }
                 } else {
                     showNotification(data.message || 'Error adding item to cart', 'error');
@@ -368,4 +367,87 @@ document.addEventListener('DOMContentLoaded', function() {
         downloadLink.click();
         document.body.removeChild(downloadLink);
     }
+    // Market price hint on crop forms
+    const marketPrice = document.getElementById('market-price');
+    if (marketPrice) {
+        const form = marketPrice.closest('form');
+        let timer = null;
+
+        const showMarketPrice = () => {
+            const name = form.querySelector('[name="name"]').value.trim();
+            const unit = form.querySelector('[name="unit"]').value;
+            const location = form.querySelector('[name="location"]').value.trim();
+            if (!name || !unit) {
+                marketPrice.textContent = '';
+                return;
+            }
+
+            const params = new URLSearchParams({ name: name, unit: unit, district: location.split(',')[0].trim() });
+            fetch(`${marketPrice.dataset.url}?${params}`)
+                .then(response => response.json())
+                .then(index => {
+                    const q = index.quantiles;
+                    if (!q) {
+                        marketPrice.textContent = `No ${unit} listings of ${name}${index.district ? ' in ' + index.district : ''} yet.`;
+                        return;
+                    }
+                    const where = index.district ? ` in ${index.district}` : '';
+                    marketPrice.textContent = `Market price${where}: median ₹${q.median}/${unit}, ` +
+                        `most between ₹${q.p25} and ₹${q.p75} (${index.count} listings).`;
+                })
+                .catch(() => { marketPrice.textContent = ''; });
+        };
+
+        ['name', 'unit', 'location'].forEach(field => {
+            form.querySelector(`[name="${field}"]`).addEventListener('input', () => {
+                clearTimeout(timer);
+                timer = setTimeout(showMarketPrice, 400);
+            });
+        });
+        showMarketPrice();
+    }
+    // Similar answered questions while a consultation is typed
+    const similarQuestions = document.getElementById('similar-questions');
+    if (similarQuestions) {
+        const form = similarQuestions.closest('form');
+        const list = similarQuestions.querySelector('.similar-questions-list');
+        let timer = null;
+
+        const showSimilarQuestions = () => {
+            const text = ['title', 'description']
+                .map(field => form.querySelector(`[name="${field}"]`).value)
+                .join(' ')
+                .trim();
+            if (text.length < 10) {
+                similarQuestions.classList.add('d-none');
+                return;
+            }
+
+            fetch(`${similarQuestions.dataset.url}?${new URLSearchParams({ q: text })}`)
+                .then(response => response.json())
+                .then(data => {
+                    list.replaceChildren();
+                    data.results.forEach(result => {
+                        const item = document.createElement('details');
+                        item.className = 'mb-2';
+                        const summary = document.createElement('summary');
+                        summary.textContent = result.title;
+                        const answer = document.createElement('p');
+                        answer.className = 'small mb-0 mt-1';
+                        answer.textContent = result.response;
+                        item.append(summary, answer);
+                        list.appendChild(item);
+                    });
+                    similarQuestions.classList.toggle('d-none', data.results.length === 0);
+                })
+                .catch(() => similarQuestions.classList.add('d-none'));
+        };
+
+        ['title', 'description'].forEach(field => {
+            form.querySelector(`[name="${field}"]`).addEventListener('input', () => {
+                clearTimeout(timer);
+                timer = setTimeout(showSimilarQuestions, 500);
+            });
+        });
+    }
 });
@@ -0,0 +1,73 @@
+"""
+Cart updates when another buyer takes a line's stock mid-request.
+
+Run with: python -m unittest discover tests
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+DATABASE = os.path.join(tempfile.mkdtemp(), 'test.db')
+os.environ['DATABASE_URL'] = 'sqlite:///' + DATABASE
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import update
+
+import init_db
+import services.holds as holds
+from app import app
+from models import Crop, StockHold, User, db
+from services.cart import cart_lines
+
+class UpdateCartRaceTest(unittest.TestCase):
+
+    def setUp(self):
+        if os.path.exists(DATABASE):
+            os.remove(DATABASE)
+        app.config.update(TESTING=True, WTF_CSRF_ENABLED=False, CART_HOLD_MINUTES=30)
+        with contextlib.redirect_stdout(io.StringIO()):
+            init_db.main()
+
+        self.client = app.test_client()
+        self.client.post('/auth/login', data={'username': 'buyer1', 'password': 'password123'})
+        with app.app_context():
+            self.first, self.second = [crop.id for crop in Crop.query.filter_by(is_active=True).order_by(Crop.id).limit(2)]
+        for crop_id in (self.first, self.second):
+            self.client.post('/buyer/cart/add', data={'crop_id': crop_id, 'quantity': 1})
+
+    def test_other_line_is_saved_when_one_loses_its_stock(self):
+        hold_stock = holds.hold_stock
+
+        def racing_hold_stock(items):
+            # Another buyer holds everything left of the second crop first
+            for crop_id, _ in items:
+                if crop_id == self.second:
+                    db.session.execute(update(Crop).where(Crop.id == crop_id)
+                                       .values(quantity_held=Crop.quantity_available))
+            return hold_stock(items)
+
+        with mock.patch.object(holds, 'hold_stock', racing_hold_stock):
+            response = self.client.post('/buyer/cart/update',
+                                        data={f'quantity_{self.first}': 3, f'quantity_{self.second}': 5},
+                                        headers={'X-Requested-With': 'XMLHttpRequest'})
+
+        body = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(body['success'])
+        self.assertEqual([line['crop_id'] for line in body['lines']], [self.first])
+        self.assertEqual([error['crop_id'] for error in body['errors']], [self.second])
+
+        with app.app_context():
+            buyer = User.query.filter_by(username='buyer1').first()
+            held = dict(db.session.query(StockHold.crop_id, StockHold.quantity).filter_by(user_id=buyer.id))
+            lines = cart_lines(buyer, [self.first, self.second])
+        self.assertEqual(held, {self.first: 3, self.second: 1})
+        self.assertEqual(lines, {self.first: 3, self.second: 1})
+
+if __name__ == '__main__':
+    unittest.main()